@@ -0,0 +1,40 @@
+import hashlib
+import struct
+
+from django.db import models
+from south.modelsinspector import add_introspection_rules
+
+
+def digest(*parts):
+    '''A 64-bit digest of parts, as a signed integer: the first 8 bytes of
+    their SHA-256.'''
+    sha = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        sha.update(part)
+    return struct.unpack('>q', sha.digest()[:8])[0]
+
+
+class DigestField(models.BigIntegerField):
+    '''A bigint column holding a digest() of some text.
+
+    Assigning or filtering by a string uses its digest, so
+    item.guid = item.link still works as it did when these were hex
+    strings. 64 bits can collide, so lookups by digest should also check
+    the text it was made from, where that's stored.
+    '''
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        if isinstance(value, basestring):
+            return digest(value)
+        return super(DigestField, self).to_python(value)
+
+    def get_prep_value(self, value):
+        if isinstance(value, basestring):
+            return digest(value)
+        return super(DigestField, self).get_prep_value(value)
+
+
+add_introspection_rules([], ['^raven\.fields\.DigestField'])
@@ -1,13 +1,62 @@
 from django.core.management.base import BaseCommand
+from django.db import connections, router, transaction
 from optparse import make_option
 
-from ...models import Feed
+from ... import viewcache
+from ...models import Feed, FeedItem, UserFeed
+
+
+def backfill_excerpts(chunk_size=500):
+    '''Fill in excerpts and word counts a chunk of items at a time, in
+    primary key order, with one UPDATE per chunk.
+
+    Each chunk is committed as it goes, and only items still lacking an
+    excerpt are looked at, so an interrupted run picks up about where it
+    left off.
+    '''
+    db = router.db_for_write(FeedItem)
+    items = FeedItem.objects.using(db).filter(excerpt='').exclude(
+        content__description='').select_related('content').order_by('pk')
+    last_pk, count = 0, 0
+    while True:
+        chunk = list(items.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        pks, excerpts, word_counts = [], [], []
+        for item in chunk:
+            item.update_excerpt()
+            pks.append(item.pk)
+            excerpts.extend([item.pk, item.excerpt])
+            word_counts.extend([item.pk, item.word_count])
+        whens = ' '.join(['WHEN %s THEN %s'] * len(chunk))
+        with transaction.commit_on_success(using=db):
+            connections[db].cursor().execute(
+                '''UPDATE raven_feeditem
+                   SET excerpt = CASE id %s END, word_count = CASE id %s END
+                   WHERE id IN (%s)''' % (
+                    whens, whens, ', '.join(['%s'] * len(pks))),
+                excerpts + word_counts + pks)
+            transaction.commit_unless_managed(using=db)
+        last_pk = chunk[-1].pk
+        count += len(chunk)
+        print 'backfilled %d excerpts, up to item %d' % (count, last_pk)
+    return count
+
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
     make_option('--kill',
         help='Comma separated list of dead feed primary keys, never to fetch again.',
         dest='dead_feeds'),
+    make_option('--recount-unread',
+        help='Rebuild every unread counter from the stored items.',
+        action='store_true', dest='recount_unread', default=False),
+    make_option('--backfill-excerpts',
+        help='Compute excerpts and word counts for items that lack them.',
+        action='store_true', dest='backfill_excerpts', default=False),
+    make_option('--view-cache-stats',
+        help='Show how often cached pages have been reused.',
+        action='store_true', dest='view_cache_stats', default=False),
     )
 
     def handle(self, *args, **options):
@@ -20,3 +69,18 @@ class Command(BaseCommand):
                 print 'subscribers: %s' % feed.subscribers
                 print
                 feed.save()
+
+        if options['recount_unread']:
+            UserFeed.recount_unread()
+            print 'recounted unread items'
+
+        if options['backfill_excerpts']:
+            count = backfill_excerpts()
+            print 'backfilled %d excerpts' % count
+
+        if options['view_cache_stats']:
+            stats = viewcache.stats()
+            total = stats['hits'] + stats['misses']
+            print 'view cache: %d hits, %d misses (%.1f%% hit rate)' % (
+                stats['hits'], stats['misses'],
+                100.0 * stats['hits'] / total if total else 0)
@@ -1,28 +1,139 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from HTMLParser import HTMLParser
 import calendar
 import logging
+import threading
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import (
+    IntegrityError, connections, models, router, transaction)
+from django.db.models import Count, F, Q
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 
 from django_push.subscriber.models import Subscription
 from django_push.subscriber.signals import updated
 from taggit.managers import TaggableManager
-from taggit.models import TaggedItem
+from taggit.models import TaggedItemBase
 
 import feedparser
-import hashlib
-from urllib2 import URLError
+from urllib2 import BaseHandler, URLError
+
+from raven.fields import DigestField, digest
+from raven.signals import items_created
 
 logger = logging.getLogger('django')
 User = get_user_model()
 
 
+class TimeoutHandler(BaseHandler):
+    '''A urllib2 handler that puts a socket timeout on every request.
+
+    feedparser builds its own opener and never passes a timeout, so a
+    single slow host can hang a fetch forever. Handing this to
+    feedparser.parse() bounds each request, redirects included.
+    '''
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def http_request(self, request):
+        request.timeout = self.timeout
+        return request
+
+    https_request = http_request
+
+
+def tags_by_object(model, object_ids):
+    '''Return a dict of pk -> list of tags for the given objects of a
+    tagged model, in one query.
+
+    object_ids may be a list or a values('pk') queryset.
+    '''
+    tagged = model.tags.through.objects.filter(
+        content_object__in=object_ids).select_related('tag')
+    tags = {}
+    for tagged_item in tagged:
+        tags.setdefault(
+            tagged_item.content_object_id, []).append(tagged_item.tag)
+    return tags
+
+
+# Per thread, the users advanced in each open sequenced() block.
+_sequencing = threading.local()
+
+
+@contextmanager
+def sequenced(model):
+    '''Run a block that advances UserSequence and writes the rows it
+    stamps as one transaction on model's write database, or as part of
+    the transaction already open there. See UserSequence.advance().'''
+    db = router.db_for_write(model)
+    stack = _sequencing.__dict__.setdefault('stack', [])
+    users = set()
+    stack.append(users)
+    try:
+        if transaction.is_managed(using=db):
+            yield db
+            _end_sequenced(db, stack)
+        else:
+            with transaction.commit_on_success(using=db):
+                yield db
+                _end_sequenced(db, stack)
+    finally:
+        stack.pop()
+
+
+def _end_sequenced(db, stack):
+    # Hand the block's users to the enclosing block, if any, so their
+    # UserSequence rows are locked as late as possible.
+    if len(stack) > 1:
+        stack[-2].update(stack[-1])
+    else:
+        UserSequence._bump(db, stack[-1])
+
+
+# The first key of the advisory locks taken by _lock_fan_out().
+FAN_OUT_LOCK = 0x7261
+
+
+def _lock_fan_out(db, feed):
+    '''Hold a lock on handing out feed's items until the transaction on db
+    ends, so an overlapping fetch or subscribe waits for us rather than
+    inserting the same rows. Only Postgres runs writers side by side.'''
+    connection = connections[db]
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute(
+            'SELECT pg_advisory_xact_lock(%s, %s)', [FAN_OUT_LOCK, feed.pk])
+
+
+def _bulk_delete(queryset, chunk_size=500):
+    '''Delete everything in a UserFeed or UserFeedItem queryset, tags too.
+
+    QuerySet.delete() loads every row into memory so the collector can
+    cascade to the tag links. Here we walk the primary keys a
+    chunk at a time and issue plain DELETEs for the tag links and then the
+    rows themselves, without ever building a model instance.
+    '''
+    model = queryset.model
+    # Read back from the same database we delete from, or replication lag
+    # would hand us the same chunk forever.
+    db = router.db_for_write(model)
+    while True:
+        pks = list(queryset.using(db).values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            break
+        model.tags.through.objects.using(db).filter(
+            content_object__in=pks)._raw_delete(db)
+        model.objects.using(db).filter(pk__in=pks)._raw_delete(db)
+        transaction.commit_unless_managed(using=db)
+
+
 class FeedManager(models.Manager):
     '''A manager for user-specific queries on Feeds.'''
 
@@ -38,6 +149,15 @@ class Feed(models.Model):
     objects = FeedManager()
 
     last_fetched = models.DateTimeField(null=True)
+    # When the scheduler should next hand this feed to a worker. Kept up
+    # to date by save(), and indexed so that finding the due feeds costs
+    # the same no matter how many feeds there are.
+    next_fetch_at = models.DateTimeField(null=True, db_index=True)
+
+    # HTTP caching validators from the last fetch, sent back on the next
+    # one so unchanged feeds answer with a cheap 304.
+    etag = models.TextField(null=True)
+    modified = models.TextField(null=True)
 
     # Required properties
     description = models.TextField()
@@ -69,6 +189,49 @@ class Feed(models.Model):
     fetch_frequency = models.IntegerField(choices=FETCH_FREQUENCY,
                                           default=FETCH_DEFAULT)
 
+    # How many of the newest items a new subscriber gets unread.
+    UNREAD_ON_SUBSCRIBE = 10
+
+    # Rolling posting statistics, see record_post(). post_interval is in
+    # seconds.
+    POST_INTERVAL_WEIGHT = 0.2
+    last_published = models.DateTimeField(null=True)
+    post_interval = models.FloatField(null=True)
+
+    # What subscribers see of a feed; see save().
+    DISPLAYED_FIELDS = ('description', 'link', 'site', 'title')
+
+    def __init__(self, *args, **kwargs):
+        super(Feed, self).__init__(*args, **kwargs)
+        self._saved_displayed = self._displayed()
+
+    def _displayed(self):
+        # From __dict__, so deferred fields aren't loaded just for this.
+        return dict((field, self.__dict__.get(field))
+                    for field in self.DISPLAYED_FIELDS)
+
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        self.schedule()
+        super(Feed, self).save(*args, **kwargs)
+        displayed = self._displayed()
+        if not created and displayed != self._saved_displayed:
+            UserFeed.feed_changed(self)
+        self._saved_displayed = displayed
+
+    def schedule(self):
+        '''Work out next_fetch_at from last_fetched and fetch_frequency.'''
+        if self.fetch_frequency == self.FETCH_NEVER:
+            self.next_fetch_at = None
+        elif self.last_fetched is None:
+            # Never fetched, so it's due right away (unless the scheduler
+            # has already claimed it).
+            if self.next_fetch_at is None:
+                self.next_fetch_at = datetime.utcnow()
+        else:
+            self.next_fetch_at = self.last_fetched + timedelta(
+                minutes=self.fetch_frequency)
+
     @property
     def subscribers(self):
         userfeeds = UserFeed.objects.filter(feed=self)
@@ -79,32 +242,61 @@ class Feed(models.Model):
         '''Add a subscriber to this feed.
 
         This not only adds an entry in the FeedUser join table, but also
-        populates UserFeedItem with unread FeedItems from the feed.
+        populates UserFeedItem with FeedItems from the feed. Only the 10
+        most recent are unread. Otherwise, the user will see feeditems
+        from years and years ago, which is not really what anyone wants.
+
+        The items go in with a single INSERT ... SELECT, so subscribing
+        costs the same number of queries however big the archive is.
+        Items the subscriber already has are left alone.
         '''
+        with sequenced(UserFeedItem) as db:
+            self._add_subscriber(subscriber, db)
+        UserFeed.recount_unread(user=subscriber, feed=self)
+
+    def _add_subscriber(self, subscriber, db):
+        _lock_fan_out(db, self)
         userfeed, new = UserFeed.objects.get_or_create(user=subscriber,
                                                        feed=self)
 
-        # Only add the 10 most recent items to the UserFeed. Otherwise,
-        # the user will see feeditems from years and years ago, which is
-        # not really what anyone wants.
-        count = 0
-        for item in self.items.order_by('-published'):
-            user_item, new = UserFeedItem.objects.get_or_create(user=subscriber, feed=self, item=item)
-
-            if count < 10:
-                count = count + 1
-            else:
-                user_item.read = True
-
-            user_item.save()
+        # A new UserFeed was just stamped by save(); an existing one needs
+        # a fresh seq so syncing clients pick up any items added back.
+        seq = userfeed.seq
+        if not new:
+            seq = UserSequence.advance([subscriber.pk])[subscriber.pk]
+
+        cursor = connections[db].cursor()
+        cursor.execute('''
+            INSERT INTO raven_userfeeditem
+                (user_id, feed_id, item_id, published, read, starred, seq)
+            SELECT %s, %s, ranked.id, ranked.published, ranked.n > %s, %s, %s
+            FROM (SELECT id, published,
+                         ROW_NUMBER() OVER (ORDER BY published DESC) AS n
+                  FROM raven_feeditem WHERE feed_id = %s) AS ranked
+            WHERE NOT EXISTS (
+                SELECT 1 FROM raven_userfeeditem
+                WHERE user_id = %s AND feed_id = %s AND item_id = ranked.id)
+            ''', [subscriber.pk, self.pk, self.UNREAD_ON_SUBSCRIBE, False,
+                  seq, self.pk, subscriber.pk, self.pk])
+        transaction.commit_unless_managed(using=db)
 
     def remove_subscriber(self, subscriber):
         '''Remove a subscriber from the feed.
 
-        Also remove all UserFeedItems.
+        Also remove all UserFeedItems, and the tags on both, leaving a
+        Tombstone for syncing clients.
         '''
-        UserFeedItem.objects.filter(user=subscriber, feed=self).delete()
-        UserFeed.objects.filter(feed=self, user=subscriber).delete()
+        db = router.db_for_write(UserFeed)
+        userfeeds = list(UserFeed.objects.using(db).filter(
+            feed=self, user=subscriber).values_list('pk', flat=True))
+        _bulk_delete(UserFeedItem.objects.filter(user=subscriber, feed=self))
+        _bulk_delete(UserFeed.objects.filter(feed=self, user=subscriber))
+        if userfeeds:
+            with sequenced(Tombstone):
+                seq = UserSequence.advance([subscriber.pk])[subscriber.pk]
+                Tombstone.objects.bulk_create([
+                    Tombstone(user=subscriber, seq=seq, userfeed_id=pk)
+                    for pk in userfeeds])
 
     def userfeed(self, user):
         userfeed = UserFeed.objects.get(user=user, feed=self)
@@ -148,26 +340,68 @@ class Feed(models.Model):
         logger.warn('Pubsubhubbbub event received! %s: %s' % (sender.id, sender.topic))
         Feed.calculate_stats()
 
+    def record_post(self, published):
+        '''Fold a newly seen item's publish date into the posting stats.
+
+        post_interval is an exponentially weighted moving average of the
+        time between posts, so calculate_stats() can tell how busy a feed
+        is without counting its items. Dates we've already seen past are
+        ignored, which also keeps re-fetched items from counting twice.
+        '''
+        if published > datetime.utcnow():
+            return
+        if self.last_published is not None:
+            if published <= self.last_published:
+                return
+            interval = (published - self.last_published).total_seconds()
+            if self.post_interval is None:
+                self.post_interval = interval
+            else:
+                self.post_interval = (
+                    self.POST_INTERVAL_WEIGHT * interval +
+                    (1 - self.POST_INTERVAL_WEIGHT) * self.post_interval)
+        self.last_published = published
+
     def calculate_stats(self):
-        self.last_fetched = datetime.utcnow()
+        now = datetime.utcnow()
+        self.last_fetched = now
+        if self.last_published is None:
+            age = None
+        else:
+            age = now - self.last_published
+
+        day = timedelta(days=1)
+
+        def posts_per_day(count):
+            return (age is not None and age < day and
+                    self.post_interval is not None and
+                    self.post_interval <= day.total_seconds() / count)
+
         # I consider this to be a lot for 1 day. Why aren't they using
         # pubsubhubbub? As for the magic number...
         # http://www.youtube.com/watch?v=tpQqH4H_SUQ#t=2m31s
-        age = datetime.utcnow() - timedelta(days=1)
-        if self.items.filter(published__gt=age).count() >= 37 and self.subscribers.count() > 1:
+        if posts_per_day(37) and self.userfeeds.count() > 1:
             self.fetch_frequency = self.FETCH_FAST
             #logger.warn('Freq (fast): %s: %s' % (self.pk, self.link))
+        elif self.fetch_frequency == self.FETCH_FAST:
+            # Fast feeds that have calmed down, or lost their audience, go
+            # back to normal. The bar is lower than for getting fast, so a
+            # feed near it doesn't flip back and forth.
+            if not posts_per_day(10) or self.userfeeds.count() < 2:
+                self.fetch_frequency = self.FETCH_DEFAULT
+                #logger.warn('Freq (demote => default): %s: %s' % (self.pk, self.link))
 
         # No posts in a year? Let's fetch slower.
-        age = datetime.utcnow() - timedelta(days=365)
-        if self.items.filter(published__gt=age).count() <= 0:
+        if age is None or age > timedelta(days=365):
             self.fetch_frequency = self.FETCH_SLOW
             #logger.warn('Freq (slow): %s: %s' % (self.pk, self.link))
+        elif self.fetch_frequency == self.FETCH_SLOW:
+            # Back from the dead.
+            self.fetch_frequency = self.FETCH_DEFAULT
 
         # No posts in 5 years? Dead feed!
-        age = datetime.utcnow() - timedelta(days=5*365)
-        if self.items.filter(published__gt=age).count() <= 0:
-            logger.warn('Freq (dead?!): %s: %s %d' % (self.pk, self.link, self.items.filter(published__gt=age).count()))
+        if age is None or age > timedelta(days=5*365):
+            logger.warn('Freq (dead?!): %s: %s %s' % (self.pk, self.link, self.last_published))
 
         # Now let's fix any mistakes we've made...
         #if self.fetch_frequency == self.FETCH_FAST:
@@ -185,29 +419,65 @@ class Feed(models.Model):
                 #self.fetch_frequency = self.FETCH_DEFAULT
                 #logger.warn('Freq (demote => default): %s: %s' % (self.pk, self.link))
 
-    def update(self, data=None, hack=False):
-        if self.fetch_frequency == self.FETCH_NEVER:
-            return
-
+    def is_fetchable(self):
+        '''Whether this feed points at something we can actually fetch.'''
         # u'user/00109242490472324272/source/com.google/link'
         if self.link.startswith('user/') or self.link.startswith('webfeed/'):
-            self.fetch_frequency = self.FETCH_NEVER
-            self.save()
-            logger.warn('NEVER fetch reader_id: %s - %s' % (self.pk, self.link))
+            return False
+        if 'twitter.com/statuses/user_timeline' in self.link:
+            return False
+        return True
+
+    def is_due(self):
+        '''Whether enough time has passed since the last fetch.'''
+        if self.last_fetched is None:
+            return True
+        age = datetime.utcnow() - self.last_fetched
+        return age >= timedelta(minutes=self.fetch_frequency)
+
+    def should_fetch(self):
+        '''Whether update() would go out to the network right now.'''
+        return (self.fetch_frequency != self.FETCH_NEVER and
+                self.is_fetchable() and self.is_due())
+
+    def fetch(self, timeout=None):
+        '''Download and parse the feed, without storing anything.
+
+        This is the network half of update(), split out so that callers
+        can download many feeds at once and hand the results to
+        update(data=...) afterwards.
+        '''
+        kwargs = {
+            'etag': self.etag,
+            'modified': self.modified,
+        }
+        if timeout is not None:
+            kwargs['handlers'] = [TimeoutHandler(timeout)]
+        return feedparser.parse(self.link, **kwargs)
+
+    def update(self, data=None, hack=False):
+        if self.fetch_frequency == self.FETCH_NEVER:
             return
 
-        if 'twitter.com/statuses/user_timeline' in self.link:
+        if not self.is_fetchable():
             self.fetch_frequency = self.FETCH_NEVER
             self.save()
             logger.warn('NEVER fetch reader_id: %s - %s' % (self.pk, self.link))
             return
 
-        age = datetime.utcnow() - self.last_fetched
-        if (age.seconds / 60) < self.fetch_frequency:
+        if not self.is_due():
             return
 
         if data is None:
-            data = feedparser.parse(self.link)
+            data = self.fetch()
+
+        # Nothing changed since the last fetch, so there is nothing to
+        # parse. Just note that we checked, and let the feed slow down if
+        # it has gone quiet.
+        if data.get('status', '') == 304:
+            self.calculate_stats()
+            self.save()
+            return
 
         if data.get('status', '') == 404:
             self.fetch_frequency = self.FETCH_NEVER
@@ -227,6 +497,11 @@ class Feed(models.Model):
             except:
                 logger.warn('Bozo: %d %s - %s' % (self.pk, self.link, data.bozo_exception))
 
+        if 'etag' in data:
+            self.etag = data.etag
+        if 'modified' in data:
+            self.modified = data.modified
+
         updated = False
         try:
             if self.title != data.feed.title:
@@ -251,15 +526,13 @@ class Feed(models.Model):
             #for link in data.feed.links:
                 #if link.rel == 'hub':
                     #self.subscription = Subscription.objects.subscribe(self.link.encode('utf-8'), hub=link.href.encode('utf-8'))
-        self.calculate_stats()
-        self.save()
-
         if hack is True:
             try:
                 last_entry = self.items.all().latest('published')
             except ObjectDoesNotExist:
                 last_entry = None
 
+        entries = []
         for entry in data.entries:
             tmp = FeedItem()
             tmp.feed = self
@@ -332,7 +605,20 @@ class Feed(models.Model):
                         tmp.published = datetime.utcnow()
 
             tmp.guid = tmp.calculate_guid()
-            item = FeedItem._get_or_create(tmp)
+            entries.append((tmp, hack_extra_sucky))
+
+        # Resolve the whole fetch against the database in one go, rather
+        # than a handful of queries per entry.
+        items = FeedItem.bulk_get_or_create(self, [tmp for tmp, _ in entries])
+
+        published = []
+        unread_items, read_items = [], []
+        for (tmp, hack_extra_sucky), (item, created) in zip(entries, items):
+            if hack_extra_sucky is False:
+                published.append(tmp.published)
+            if not created:
+                # Subscribers already have it.
+                continue
 
             mark_as_read = False
             if hack is True and last_entry is not None:
@@ -344,7 +630,21 @@ class Feed(models.Model):
                     # not have a date and we stuffed in utcnow()
                     mark_as_read = True
 
-            UserFeedItem.add_to_users(self, item, mark_as_read)
+            if mark_as_read:
+                read_items.append(item)
+            else:
+                unread_items.append(item)
+
+        if unread_items:
+            items_created.send(sender=self, items=unread_items)
+        if read_items:
+            items_created.send(sender=self, items=read_items,
+                               mark_as_read=True)
+
+        for date in sorted(published):
+            self.record_post(date)
+        self.calculate_stats()
+        self.save()
 
 
     # Currently unused RSS (optional) properties:
@@ -397,31 +697,33 @@ class FeedItem(models.Model):
     class Meta:
         unique_together = ('feed', 'guid')
         index_together = [
-            ['feed', 'guid'],
             ['feed', 'link'],
             ['feed', 'title'],
-            ['feed', 'atom_id'],
             ['feed', 'published'],
         ]
 
     feed = models.ForeignKey(Feed, related_name='items')
 
     # Required properties
-    description = models.TextField()
+    # description is stored in FeedItemContent; see the property below.
     # It's possible to have longer urls, but anything longer than 2083
     # characters will break in IE.
     link = models.URLField(max_length=1023)
     # We need an index on 'link' but 99% will all start with 'http://'
     # so let's index on a hash of the link instead.
     # http://inessential.com/2013/03/18/brians_stupid_feed_tricks
-    link_hash = models.CharField(max_length=128, default='', db_index=True)
+    link_hash = DigestField(default=0, db_index=True)
     title = models.TextField()
 
     # Various GUIDs
     #   guid        - internally calculated
     #   atom_id     - supplied by feedparser, optional
-    guid = models.CharField(max_length=128, unique=True)
-    atom_id = models.TextField(default='', db_index=True)
+    # The hashes are 64-bit digests (see raven.fields) to keep the indexes
+    # on this, our biggest table, small; lookups by link_hash or
+    # atom_id_hash check the text too, in case of collisions.
+    guid = DigestField()
+    atom_id = models.TextField(default='')
+    atom_id_hash = DigestField(default=0, db_index=True)
 
     # Legacy google reader longform unique id
     # https://code.google.com/p/google-reader-api/wiki/ItemId
@@ -430,30 +732,68 @@ class FeedItem(models.Model):
     # Optional metadata
     published = models.DateTimeField(db_index=True)
 
+    # Plain-text summary of description, for list views, kept up to date
+    # by save() (and bulk_get_or_create(), which doesn't call it).
+    excerpt = models.TextField(default='')
+    word_count = models.IntegerField(default=0)
+
+    EXCERPT_WORDS = 50
+
+    def _get_description(self):
+        if not hasattr(self, '_description'):
+            self._description = u''
+            if self.pk is not None:
+                try:
+                    self._description = self.content.description
+                except FeedItemContent.DoesNotExist:
+                    pass
+        return self._description
+
+    def _set_description(self, value):
+        self._description = value
+        self._description_changed = True
+
+    # Loaded from FeedItemContent on first use; select_related('content')
+    # to load it along with the item.
+    description = property(_get_description, _set_description)
+
+    def save(self, *args, **kwargs):
+        changed = getattr(self, '_description_changed', False)
+        if changed:
+            self.update_excerpt()
+        self.update_link_hash()
+        self.atom_id_hash = digest(self.atom_id)
+        if self.guid is None:
+            self.guid = self.calculate_guid()
+        super(FeedItem, self).save(*args, **kwargs)
+        if changed:
+            FeedItemContent(item_id=self.pk,
+                            description=self._description).save()
+            self._description_changed = False
+
+    def update_excerpt(self):
+        '''Set excerpt and word_count from description.'''
+        words = HTMLParser().unescape(strip_tags(self.description)).split()
+        self.word_count = len(words)
+        self.excerpt = Truncator(u' '.join(words)).words(self.EXCERPT_WORDS)
+
     def userfeeditem(self, user):
         userfeeditem = UserFeedItem.objects.get(
             user=user, item=self)
         return userfeeditem
 
     def update_link_hash(self):
-        link_hash = hashlib.sha256()
-        link_hash.update(self.link.encode('utf-8'))
-        self.link_hash = link_hash.hexdigest()
+        self.link_hash = digest(self.link)
 
     def calculate_guid(self):
-        # guid is the sha256 of:
+        # guid is the digest of:
         #   parent feed.link
         #   entry.link
         #   entry.id
         #   entry.title
-        guid = hashlib.sha256()
-        guid.update(self.feed.link.encode('utf-8'))
-        guid.update(self.link.encode('utf-8'))
-        guid.update(self.atom_id.encode('utf-8'))
-        guid.update(self.title.encode('utf-8'))
         #if self.reader_guid:
             #guid.update(self.reader_guid)
-        return guid.hexdigest()
+        return digest(self.feed.link, self.link, self.atom_id, self.title)
 
     # Currently unused RSS (optional) properties:
     # author: <author>bob@example.com</author>
@@ -464,50 +804,82 @@ class FeedItem(models.Model):
     # pubDate: <pubDate>Thu, 4 Apr 2013</pubDate>
     # source: <source url="http://...">Example.com</source>
 
-    def _update_entry(item, tmp):
+    def _merge_entry(item, tmp):
+        '''Copy a newly fetched entry onto a stored item.
+
+        Returns True if the item changed and needs saving.
+        '''
         # item is retrieved object, tmp is newly fetched object
         if item.published > tmp.published:
-            return item
+            return False
 
         # Assume newer is better... as long as it exists
+        changed = False
         for attr in ['atom_id', 'link', 'title', 'guid', 'published',
                      'description']:
-            if hasattr(tmp, attr):
+            if hasattr(tmp, attr) and getattr(item, attr) != getattr(tmp, attr):
                 setattr(item, attr, getattr(tmp, attr))
+                changed = True
                 if attr == 'link':
                     item.update_link_hash()
 
-        item.guid = item.calculate_guid()
-        item.save()
+        guid = item.calculate_guid()
+        if item.guid != guid:
+            item.guid = guid
+            changed = True
+        return changed
+
+    def _delete_duplicate(self):
+        '''Delete a duplicate item, and everyone's copy of it, keeping
+        their unread counts right and their cached views fresh.'''
+        with sequenced(UserFeedItem) as db:
+            user_items = UserFeedItem.objects.using(db).filter(item=self)
+            users = set(user_items.values_list('user', flat=True))
+            feeds = set(user_items.filter(read=False).values_list(
+                'feed', flat=True))
+            UserSequence.advance(users)
+            self.delete(using=db)
+            for feed in feeds:
+                UserFeed.recount_unread(feed=feed)
+
+    def _update_entry(item, tmp):
+        if FeedItem._merge_entry(item, tmp):
+            item.save()
         return item
 
     def _get_or_create(tmp):
         # Search for atom_id first
         try:
             if tmp.atom_id != '':
-                item = FeedItem.objects.get(atom_id=tmp.atom_id)
+                item = FeedItem.objects.get(
+                    atom_id_hash=digest(tmp.atom_id), atom_id=tmp.atom_id)
                 return FeedItem._update_entry(item, tmp)
         except ObjectDoesNotExist:
             pass
         except MultipleObjectsReturned:
-            qs = FeedItem.objects.filter(atom_id=tmp.atom_id).order_by('-published')
+            qs = FeedItem.objects.filter(
+                atom_id_hash=digest(tmp.atom_id), atom_id=tmp.atom_id
+            ).order_by('-published')
             for item in qs[1:]:
                 logger.warn('Deleting duplicate atom_id: %s' % item.atom_id)
-                item.delete()
+                item._delete_duplicate()
             return FeedItem._update_entry(qs[0], tmp)
 
         # Search for link next
         try:
             if tmp.link != '':
-                item = FeedItem.objects.get(link_hash=tmp.link_hash)
+                item = FeedItem.objects.get(
+                    link_hash=digest(tmp.link), link=tmp.link)
                 return FeedItem._update_entry(item, tmp)
         except ObjectDoesNotExist:
             pass
         except MultipleObjectsReturned:
-            qs = FeedItem.objects.filter(link_hash=tmp.link_hash).order_by('-published')
+            qs = FeedItem.objects.filter(
+                link_hash=digest(tmp.link), link=tmp.link
+            ).order_by('-published')
             for item in qs[1:]:
                 logger.warn('Deleting duplicate link: %s' % item.link)
-                item.delete()
+                item._delete_duplicate()
             return FeedItem._update_entry(qs[0], tmp)
 
         # Last resort, get_or_create our own GUID
@@ -516,10 +888,167 @@ class FeedItem(models.Model):
                            defaults={ 'published': tmp.published,
                                       'description': tmp.description,
                                       'link' : tmp.link,
+                                      'link_hash' : tmp.link_hash,
                                       'atom_id': tmp.atom_id,
                                       'title' : tmp.title })
         return item
 
+    @classmethod
+    def bulk_get_or_create(Class, feed, tmps):
+        '''Batch version of _get_or_create() for every entry of one fetch.
+
+        Entries are matched the same way (atom_id, then link, then our own
+        GUID within the feed), but against a single query for the whole
+        batch. Only items that actually changed are saved, and new ones
+        are inserted with one bulk_create(). Returns a list of
+        (item, created) pairs in the same order as tmps.
+        '''
+        if not tmps:
+            return []
+
+        # Look rows up by digest, but index them by the text itself, so a
+        # digest collision can't match the wrong item.
+        atom_ids = set(tmp.atom_id for tmp in tmps if tmp.atom_id != '')
+        links = set(tmp.link for tmp in tmps if tmp.link != '')
+        query = Q(feed=feed, guid__in=set(tmp.guid for tmp in tmps))
+        if atom_ids:
+            query |= Q(atom_id_hash__in=set(digest(a) for a in atom_ids))
+        if links:
+            query |= Q(link_hash__in=set(digest(link) for link in links))
+
+        # Everything here is read from the database we write to: items a
+        # lagging replica hasn't seen yet would be inserted twice, and new
+        # ones would come back without primary keys.
+        db = router.db_for_write(Class)
+        by_atom_id, by_link, by_guid = {}, {}, {}
+        matches = Class.objects.using(db).filter(query).select_related(
+            'content').order_by('-published')
+        for item in matches:
+            if item.feed_id == feed.pk:
+                # Saves a query per item in calculate_guid()
+                item.feed = feed
+            by_atom_id.setdefault(item.atom_id, []).append(item)
+            by_link.setdefault(item.link, []).append(item)
+            if item.feed_id == feed.pk:
+                by_guid[item.guid] = [item]
+
+        # Like the MultipleObjectsReturned handling in _get_or_create(),
+        # keep the newest of any duplicates and delete the rest.
+        deleted = set()
+
+        def lookup(index, key, what):
+            matches = [item for item in index.get(key, [])
+                       if id(item) not in deleted]
+            for item in matches[1:]:
+                logger.warn('Deleting duplicate %s: %s' % (what, key))
+                if item.pk is not None:
+                    item._delete_duplicate()
+                deleted.add(id(item))
+            if matches:
+                return matches[0]
+            return None
+
+        results = []
+        changed = {}
+        new = []
+        for tmp in tmps:
+            item = None
+            if tmp.atom_id != '':
+                item = lookup(by_atom_id, tmp.atom_id, 'atom_id')
+            if item is None and tmp.link != '':
+                item = lookup(by_link, tmp.link, 'link')
+            if item is None:
+                item = lookup(by_guid, tmp.guid, 'guid')
+
+            if item is None:
+                item = Class(feed=feed, guid=tmp.guid,
+                             published=tmp.published,
+                             description=tmp.description, link=tmp.link,
+                             link_hash=tmp.link_hash, atom_id=tmp.atom_id,
+                             title=tmp.title)
+                new.append(item)
+                created = True
+            else:
+                created = any(item is other for other in new)
+                if Class._merge_entry(item, tmp) and not created:
+                    changed[id(item)] = item
+
+            # Later entries in the same fetch may match this one.
+            by_atom_id.setdefault(item.atom_id, [item])
+            by_link.setdefault(item.link, [item])
+            by_guid.setdefault(item.guid, [item])
+            results.append((item, created))
+
+        for key, item in changed.items():
+            if key not in deleted:
+                item.save()
+
+        if new and not Class._bulk_insert(db, feed, new):
+            # Someone else inserted some of these since we looked, so go
+            # through them one at a time, like _get_or_create() does.
+            # Whichever were already there are theirs to hand out.
+            resolved = {}
+            for item in new:
+                resolved[id(item)] = Class.objects.using(db).get_or_create(
+                    feed=feed, guid=item.guid, defaults={
+                        'published': item.published,
+                        'description': item.description,
+                        'link': item.link, 'atom_id': item.atom_id,
+                        'title': item.title})
+            results = [resolved.get(id(item), (item, created))
+                       for item, created in results]
+
+        return results
+
+    @classmethod
+    def _bulk_insert(Class, db, feed, new):
+        '''Insert new items of feed, and their content, in bulk. Returns
+        False, having inserted nothing, if any of them clash with a row
+        that's already there.'''
+        for item in new:
+            item.update_excerpt()
+            item.update_link_hash()
+            item.atom_id_hash = digest(item.atom_id)
+        sid = transaction.savepoint(using=db)
+        try:
+            Class.objects.using(db).bulk_create(new)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=db)
+            return False
+        transaction.savepoint_commit(sid, using=db)
+
+        # bulk_create() doesn't hand back primary keys, so fetch them,
+        # matching on everything we key items by.
+        key = lambda item: (item.guid, item.link_hash, item.atom_id_hash)
+        pks = dict(
+            ((guid, link_hash, atom_id_hash), pk)
+            for guid, link_hash, atom_id_hash, pk in
+            Class.objects.using(db).filter(
+                feed=feed, guid__in=[item.guid for item in new]
+            ).values_list('guid', 'link_hash', 'atom_id_hash', 'pk'))
+        for item in new:
+            item.pk = pks.get(key(item))
+            item._description_changed = False
+        FeedItemContent.objects.using(db).bulk_create([
+            FeedItemContent(item_id=item.pk, description=item.description)
+            for item in new])
+        return True
+
+class FeedItemContent(models.Model):
+    '''The body of a FeedItem.
+
+    Kept out of FeedItem so the columns we filter and sort on stay in
+    narrow rows; only code that needs the body joins it in. Use
+    FeedItem.description rather than this directly.
+
+    On Postgres the table also has a search tsvector column, over the
+    item's title and description, which triggers keep up to date. See
+    UserFeedItem.search().
+    '''
+    item = models.OneToOneField(
+        FeedItem, primary_key=True, related_name='content')
+    description = models.TextField()
+
 
 # User monkeypatches
 @property
@@ -550,26 +1079,101 @@ class UserFeed(models.Model):
         unique_together = ('user', 'feed')
         index_together = [
             ['user', 'feed'],
+            ['user', 'seq'],
         ]
 
     feed = models.ForeignKey(Feed, related_name='userfeeds')
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, related_name='userfeeds')
-    tags = TaggableManager()
+    tags = TaggableManager(through='TaggedUserFeed')
+
+    # The user's UserSequence as of the last change, for delta sync.
+    seq = models.BigIntegerField(default=0)
+
+    # Denormalised count of this user's unread items in the feed. It is
+    # kept up to date by UserFeedItem.save(), UserFeedItem.add_to_users()
+    # and Feed.add_subscriber(); recount_unread() rebuilds it from scratch.
+    unread = models.IntegerField(default=0)
+
+    def save(self, *args, **kwargs):
+        with sequenced(UserFeed):
+            self.seq = UserSequence.advance([self.user_id])[self.user_id]
+            super(UserFeed, self).save(*args, **kwargs)
 
     def unread_count(self):
         '''Return the UserFeedItem unread count.'''
-        return UserFeedItem.objects.filter(
-            user=self.user, feed=self.feed, read=False).count()
+        return self.unread
+
+    @classmethod
+    def feed_changed(Class, feed):
+        '''Restamp every subscription to a feed whose title, link or
+        description changed, so syncing clients and cached pages pick it
+        up. See UserFeedItem.item_changed().'''
+        with sequenced(Class) as db:
+            users = list(Class.objects.using(db).filter(
+                feed=feed).values_list('user', flat=True))
+            if not users:
+                return
+            UserSequence.advance(users)
+            connections[db].cursor().execute('''
+                UPDATE raven_userfeed SET seq = %s WHERE feed_id = %%s
+                ''' % UserSequence.stamp_sql(db, 'raven_userfeed.user_id'),
+                [feed.pk])
+            transaction.commit_unless_managed(using=db)
+
+    @staticmethod
+    def recount_unread(user=None, feed=None):
+        '''Recompute the unread counters from UserFeedItem.
+
+        Only the UserFeeds for user and/or feed (instances or pks) are
+        fixed up if given, otherwise every one is. Either way it's a single
+        UPDATE.
+        '''
+        where, params = [], [False]
+        if user is not None:
+            where.append('raven_userfeed.user_id = %s')
+            params.append(getattr(user, 'pk', user))
+        if feed is not None:
+            where.append('raven_userfeed.feed_id = %s')
+            params.append(getattr(feed, 'pk', feed))
+
+        sql = '''
+            UPDATE raven_userfeed SET unread = (
+                SELECT COUNT(*) FROM raven_userfeeditem
+                WHERE raven_userfeeditem.user_id = raven_userfeed.user_id
+                  AND raven_userfeeditem.feed_id = raven_userfeed.feed_id
+                  AND raven_userfeeditem.read = %s)
+            '''
+        if where:
+            sql += 'WHERE ' + ' AND '.join(where)
+
+        db = router.db_for_write(UserFeed)
+        connections[db].cursor().execute(sql, params)
+        transaction.commit_unless_managed(using=db)
+
+    @staticmethod
+    def tags_by_userfeed(user):
+        '''Return a dict of UserFeed pk -> list of tags, for all of a
+        user's UserFeeds in one query.'''
+        return tags_by_object(
+            UserFeed, UserFeed.objects.filter(user=user).values('pk'))
+
+    @staticmethod
+    def remove_user(user):
+        '''Remove all of a user's subscriptions and reading history.
+
+        Used when deleting an account; see Feed.remove_subscriber.
+        '''
+        _bulk_delete(UserFeedItem.objects.filter(user=user))
+        _bulk_delete(UserFeed.objects.filter(user=user))
 
     @staticmethod
     def userfeed_tags(user):
         '''Return all the UserFeed tags for a user.'''
-        #ct = ContentType.objects.get_for_model(UserFeed)
         kwargs = {
             "userfeed__in": UserFeed.objects.filter(user=user)
         }
-        tags = TaggedItem.tag_model().objects.filter(**kwargs).distinct()
+        tags = TaggedUserFeed.tag_model().objects.filter(**kwargs).distinct()
         return tags
 
 
@@ -578,8 +1182,14 @@ class UserFeedItem(models.Model):
 
     class Meta:
         unique_together = ('user', 'feed', 'item',)
+        # The river and per-feed views filter on user (and feed) and read,
+        # and sort on published. Postgres also gets partial indexes on the
+        # unread rows alone; see migration 0030.
         index_together = [
             ['user', 'feed', 'read', 'item'],
+            ['user', 'read', 'published'],
+            ['user', 'feed', 'read', 'published'],
+            ['user', 'seq'],
         ]
 
     item = models.ForeignKey(FeedItem, related_name='userfeeditems')
@@ -587,25 +1197,420 @@ class UserFeedItem(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, related_name='userfeeditems')
 
+    # A copy of item.published, so reading lists can be sorted without
+    # joining FeedItem.
+    published = models.DateTimeField()
+
     read = models.BooleanField(default=False)
     starred = models.BooleanField(default=False)
-    tags = TaggableManager()
+    tags = TaggableManager(through='TaggedUserFeedItem')
+
+    # The user's UserSequence as of the last change, for delta sync.
+    seq = models.BigIntegerField(default=0)
+
+    # Rows per INSERT when handing items out in bulk.
+    BATCH_SIZE = 500
+
+    # How many of the newest matches search() ranks.
+    SEARCH_CANDIDATES = 500
+
+    # The fields changed_state() reports on.
+    STATE_FIELDS = ('read', 'starred')
+
+    def __init__(self, *args, **kwargs):
+        super(UserFeedItem, self).__init__(*args, **kwargs)
+        self._remember_saved()
+
+    def _remember_saved(self):
+        # Field values as of the last load or save, so save() knows how
+        # to adjust UserFeed.unread and changed_state() what changed.
+        # Deferred fields are left out.
+        self._saved = dict(
+            (field.attname, self.__dict__[field.attname])
+            for field in self._meta.fields if field.attname in self.__dict__)
+
+    def changed_fields(self):
+        '''Return the names of the fields changed since the last load or
+        save.'''
+        return set(
+            name for name, value in self._saved.items()
+            if getattr(self, name) != value)
+
+    def changed_state(self):
+        '''Return a dict of the read and starred values that changed
+        since the last load or save.'''
+        return dict(
+            (field, getattr(self, field)) for field in self.STATE_FIELDS
+            if field in self.changed_fields())
+
+    def refresh_state(self):
+        '''Reload the saved read and starred state from the database, for
+        when it was written behind this instance's back. The values set
+        on the instance are kept.'''
+        saved = UserFeedItem.objects.using(
+            router.db_for_write(UserFeedItem)).filter(pk=self.pk).values(
+                *self.STATE_FIELDS)
+        for row in saved:
+            self._saved.update(row)
+
+    def _adjust_unread(self, delta):
+        if delta:
+            UserFeed.objects.filter(
+                user=self.user_id, feed=self.feed_id).update(
+                    unread=F('unread') + delta)
+
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        if self.published is None:
+            self.published = self.item.published
+        with sequenced(UserFeedItem):
+            self.seq = UserSequence.advance([self.user_id])[self.user_id]
+            super(UserFeedItem, self).save(*args, **kwargs)
+            if created:
+                self._adjust_unread(0 if self.read else 1)
+            elif self._saved.get('read') is not None:
+                self._adjust_unread(
+                    int(self._saved['read']) - int(self.read))
+        self._remember_saved()
+
+    def delete(self, *args, **kwargs):
+        if not self._saved.get('read', True):
+            self._adjust_unread(-1)
+        super(UserFeedItem, self).delete(*args, **kwargs)
+
+    @staticmethod
+    def search(items, query):
+        '''Narrow items, a UserFeedItem queryset, to those whose title or
+        description match query, best matches first.
+
+        On Postgres this uses the full-text index on FeedItemContent and
+        ranks the newest SEARCH_CANDIDATES matches by ts_rank; older ones
+        don't come back. Elsewhere it falls back to matching every word
+        somewhere in the title or description, newest first.
+        '''
+        if connections[items.db].vendor == 'postgresql':
+            matches = FeedItemContent.objects.extra(
+                where=["search @@ plainto_tsquery('english', %s)"],
+                params=[query]).values('item')
+            # Rank a bounded set of candidates rather than every match,
+            # which would all have to be ranked before a page could be
+            # cut from them.
+            candidates = items.filter(item__in=matches).order_by(
+                '-published').values('pk')[:UserFeedItem.SEARCH_CANDIDATES]
+            return items.filter(pk__in=candidates).extra(
+                select={'rank': '''(
+                    SELECT ts_rank(search, plainto_tsquery('english', %s))
+                    FROM raven_feeditemcontent
+                    WHERE raven_feeditemcontent.item_id =
+                          raven_userfeeditem.item_id)'''},
+                select_params=[query],
+            ).order_by('-rank', '-published')
+
+        for word in query.split():
+            items = items.filter(
+                Q(item__title__icontains=word) |
+                Q(item__content__description__icontains=word))
+        return items.order_by('-published')
+
+    @classmethod
+    def mark_read(Class, user, feeds=None, before=None):
+        '''Mark a user's unread items read with a single UPDATE.
+
+        feeds narrows it down to items from those Feeds, and before to
+        items published before then. Returns a dict of feed pk -> number
+        of items marked read.
+        '''
+        items = Class.objects.filter(user=user, read=False)
+        if feeds is not None:
+            items = items.filter(feed__in=feeds)
+        if before is not None:
+            items = items.filter(published__lt=before)
+
+        counts = dict(items.values_list('feed').annotate(Count('pk')))
+        if counts:
+            user_id = getattr(user, 'pk', user)
+            with sequenced(Class):
+                items.update(
+                    read=True, seq=UserSequence.advance([user_id])[user_id])
+            if len(counts) == 1:
+                UserFeed.recount_unread(user=user, feed=counts.keys()[0])
+            else:
+                UserFeed.recount_unread(user=user)
+        return counts
 
     @classmethod
-    def add_to_users(Class, feed, item, mark_as_read=False):
+    def add_to_users(Class, feed, items, mark_as_read=False):
+        '''Hand items out to everyone subscribed to feed.
+
+        This is set-based: one query for the subscribers, then an
+        INSERT ... SELECT per BATCH_SIZE items that skips rows which
+        already exist, as Feed.add_subscriber() does. New rows are read
+        if mark_as_read is set or the item predates us.
+
+        Everything runs on the write database, in one transaction holding
+        the feed's fan-out lock, so an overlapping fetch or subscribe
+        waits for us rather than inserting the same rows. Subscribers'
+        reads and stars don't wait.
+        '''
         threshold = datetime(2013, 3, 13)
-        for user in feed.subscribers.all():
-            ufi, new = UserFeedItem.objects.get_or_create(user=user, feed=feed, item=item)
-            if mark_as_read is True:
-                ufi.read = True
+        item_pks = sorted(set(item.pk for item in items
+                              if item.pk is not None))
+        if not item_pks:
+            return
 
-            if item.published < threshold:
-                ufi.read = True
+        with sequenced(Class) as db:
+            _lock_fan_out(db, feed)
+            users = list(UserFeed.objects.using(db).filter(
+                feed=feed).values_list('user', flat=True))
+            if not users:
+                return
+            UserSequence.advance(users)
+
+            connection = connections[db]
+            cursor = connection.cursor()
+            for i in xrange(0, len(item_pks), Class.BATCH_SIZE):
+                batch = item_pks[i:i + Class.BATCH_SIZE]
+                cursor.execute('''
+                    INSERT INTO raven_userfeeditem
+                        (user_id, feed_id, item_id, published, read, starred,
+                         seq)
+                    SELECT s.user_id, %%s, i.id, i.published,
+                           (%%s OR i.published < %%s), %%s, %s
+                    FROM raven_userfeed s, raven_feeditem i
+                    WHERE s.feed_id = %%s AND s.user_id IN (%s)
+                      AND i.id IN (%s)
+                      AND NOT EXISTS (
+                        SELECT 1 FROM raven_userfeeditem
+                        WHERE user_id = s.user_id AND item_id = i.id)
+                    ''' % (UserSequence.stamp_sql(db, 's.user_id'),
+                           ', '.join(['%s'] * len(users)),
+                           ', '.join(['%s'] * len(batch))),
+                    [feed.pk, mark_as_read,
+                     connection.ops.value_to_db_datetime(threshold), False,
+                     feed.pk] + users + batch)
+            transaction.commit_unless_managed(using=db)
+
+            # The rows we just inserted are the only ones of these items
+            # carrying our stamp, so count the unread ones among them.
+            stamp = UserSequence.stamp_sql(db, 'raven_userfeeditem.user_id')
+            unread = Class.objects.using(db).filter(
+                feed=feed, item__in=item_pks, read=False).extra(
+                    where=['raven_userfeeditem.seq = ' + stamp]
+                ).values_list('user').annotate(Count('pk'))
+
+            # Bump the counters with one UPDATE per distinct increment,
+            # which is almost always just the one.
+            by_count = {}
+            for user, count in unread:
+                by_count.setdefault(count, []).append(user)
+            for count, users in by_count.items():
+                UserFeed.objects.using(db).filter(
+                    feed=feed, user__in=users).update(
+                        unread=F('unread') + count)
 
-            ufi.save()
+    @classmethod
+    def item_changed(Class, item):
+        '''Restamp everyone's copy of an edited item, so syncing clients
+        fetch its new title, description or date, and move it in reading
+        lists if it was republished.'''
+        with sequenced(Class) as db:
+            users = list(Class.objects.using(db).filter(
+                item=item).values_list('user', flat=True))
+            if not users:
+                return
+            UserSequence.advance(users)
+            connection = connections[db]
+            stamp = UserSequence.stamp_sql(db, 'raven_userfeeditem.user_id')
+            connection.cursor().execute('''
+                UPDATE raven_userfeeditem SET published = %%s, seq = %s
+                WHERE item_id = %%s
+                ''' % stamp,
+                [connection.ops.value_to_db_datetime(item.published),
+                 item.pk])
+            transaction.commit_unless_managed(using=db)
+
+    @receiver(items_created)
+    def items_created_callback(sender, **kwargs):
+        UserFeedItem.add_to_users(
+            sender, kwargs['items'], kwargs.get('mark_as_read', False))
 
     @receiver(post_save, sender=FeedItem)
     def feeditem_callback(sender, **kwargs):
+        # Only brand new items need handing out. Edits to an existing
+        # item don't change who should have it, but everyone's copy needs
+        # restamping.
         item = kwargs['instance']
-        feed = item.feed
-        UserFeedItem.add_to_users(feed, item)
+        if not kwargs['created']:
+            UserFeedItem.item_changed(item)
+            return
+        items_created.send(sender=item.feed, items=[item])
+
+
+class UserSequence(models.Model):
+    '''A per-user change counter, for delta sync and cached views.
+
+    Every write to a user's UserFeeds and UserFeedItems stamps them with
+    a value from advance(), so a client holding a sync position from
+    horizon() can ask for everything stamped after it. seq itself moves
+    on with every such write, so it tells when anything of the user's
+    changed.
+
+    On Postgres the stamps are the writing transaction's id rather than
+    seq, so writers never wait on each other to get one; see advance().
+    '''
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, related_name='sequence')
+    seq = models.BigIntegerField(default=0)
+
+    @classmethod
+    def advance(Class, users):
+        '''Get the stamp for writes to users (pks), returning a dict of
+        user pk -> stamp.
+
+        Call it inside sequenced(), along with the writes it stamps.
+        Elsewhere the stamp is the user's bumped seq. On Postgres it is
+        txid_current(), which takes no locks, and the users' seqs are
+        only bumped as the outermost sequenced() block ends, so their rows
+        are locked for no longer than it takes to commit. horizon() keeps
+        syncing clients behind transactions still in flight.
+        '''
+        users = sorted(set(users))
+        db = router.db_for_write(Class)
+        connection = connections[db]
+        if connection.vendor != 'postgresql':
+            return Class._bump(db, users)
+
+        stack = getattr(_sequencing, 'stack', None)
+        if stack:
+            stack[-1].update(users)
+        else:
+            Class._bump(db, users)
+        cursor = connection.cursor()
+        cursor.execute('SELECT txid_current()')
+        stamp = cursor.fetchone()[0]
+        return dict((user, stamp) for user in users)
+
+    @classmethod
+    def _bump(Class, db, users):
+        '''Bump the seq of each of users (pks), returning a dict of user
+        pk -> new value.'''
+        users = sorted(set(users))
+        seqs = Class._advance(db, users)
+        missing = [user for user in users if user not in seqs]
+        if missing:
+            for user in missing:
+                Class.objects.using(db).get_or_create(user_id=user)
+            seqs.update(Class._advance(db, missing))
+        return seqs
+
+    @classmethod
+    def _advance(Class, db, users):
+        if not users:
+            return {}
+        connection = connections[db]
+        if connection.vendor != 'postgresql':
+            objects = Class.objects.using(db).filter(user__in=users)
+            objects.update(seq=F('seq') + 1)
+            return dict(objects.values_list('user', 'seq'))
+
+        # Lock the rows in user order, so two writers advancing
+        # overlapping sets of users can't deadlock.
+        cursor = connection.cursor()
+        cursor.execute('''
+            UPDATE raven_usersequence SET seq = seq + 1
+            WHERE user_id IN (
+                SELECT user_id FROM raven_usersequence
+                WHERE user_id IN %s ORDER BY user_id FOR UPDATE)
+            RETURNING user_id, seq
+            ''', [tuple(users)])
+        seqs = dict(cursor.fetchall())
+        transaction.commit_unless_managed(using=db)
+        return seqs
+
+    @staticmethod
+    def stamp_sql(db, user_id):
+        '''SQL for the stamp advance() hands out on db, for statements
+        that stamp many users' rows at once. user_id is the SQL for the
+        user the row belongs to.'''
+        if connections[db].vendor == 'postgresql':
+            return 'txid_current()'
+        return ('''(SELECT seq FROM raven_usersequence
+                    WHERE raven_usersequence.user_id = %s)''' % user_id)
+
+    @classmethod
+    def current(Class, user, using=None):
+        '''The user's latest sequence number, 0 if they've never changed
+        anything.'''
+        seqs = Class.objects.using(using).filter(user=user).values_list(
+            'seq', flat=True)
+        return seqs[0] if seqs else 0
+
+    @classmethod
+    def horizon(Class, user, using=None):
+        '''The highest stamp at or below which every change of user's is
+        already visible on the using database.
+
+        Take it before reading the changes. On Postgres, transactions
+        commit out of stamp order, so it stops short of the oldest one
+        still running.
+        '''
+        connection = connections[using or router.db_for_read(Class)]
+        if connection.vendor != 'postgresql':
+            return Class.current(user, using=using)
+        cursor = connection.cursor()
+        cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        return cursor.fetchone()[0] - 1
+
+
+class Tombstone(models.Model):
+    '''Marks a UserFeed that was removed, for delta sync.'''
+
+    class Meta:
+        index_together = [
+            ['user', 'seq'],
+        ]
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='tombstones')
+    seq = models.BigIntegerField()
+    userfeed_id = models.IntegerField()
+
+
+class TaggedUserFeed(TaggedItemBase):
+    '''A tag on a UserFeed.
+
+    taggit's default TaggedItem is generic, keyed on content type and
+    object id, so every tag filter went through a polymorphic join. A
+    plain foreign key makes it a single indexed one.
+    '''
+
+    class Meta:
+        unique_together = ('content_object', 'tag')
+
+    content_object = models.ForeignKey(UserFeed)
+
+
+class TaggedUserFeedItem(TaggedItemBase):
+    '''A tag on a UserFeedItem; see TaggedUserFeed.'''
+
+    class Meta:
+        unique_together = ('content_object', 'tag')
+
+    content_object = models.ForeignKey(UserFeedItem)
+
+
+@receiver(post_save, sender=TaggedUserFeed)
+@receiver(post_delete, sender=TaggedUserFeed)
+@receiver(post_save, sender=TaggedUserFeedItem)
+@receiver(post_delete, sender=TaggedUserFeedItem)
+def tagged_item_callback(sender, **kwargs):
+    # Tagging doesn't save the UserFeed or UserFeedItem itself, so stamp
+    # it here or syncing clients would never hear about it.
+    tagged_item = kwargs['instance']
+    model = sender._meta.get_field('content_object').rel.to
+    objects = model.objects.filter(pk=tagged_item.content_object_id)
+    users = list(objects.values_list('user', flat=True))
+    if users:
+        with sequenced(model):
+            objects.update(seq=UserSequence.advance(users)[users[0]])
@@ -0,0 +1,130 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+
+class CursorPaginator(Paginator):
+    '''Keyset pagination on (published, id).
+
+    Rather than an offset, meta.next and meta.previous carry an opaque
+    cursor naming the last (or first) row of the page, and the next page
+    is the rows strictly after it. Fetching page N therefore costs the
+    same as page 1, and pages don't shift when rows before them go away
+    (say, because they were just marked read).
+
+    Only the first page has meta.total_count. Requests that still pass
+    an offset are paged the old way.
+    '''
+    key = 'published'
+    cursor_param = 'cursor'
+
+    def page(self):
+        if 'offset' in self.request_data:
+            return super(CursorPaginator, self).page()
+
+        limit = self.get_limit()
+        cursor = self.get_cursor()
+        descending = self.is_descending()
+        # Paging backwards is paging forwards in the opposite order.
+        forwards = cursor is None or cursor[0] == 'n'
+        if not forwards:
+            descending = not descending
+
+        objects = self.objects
+        if cursor is not None:
+            objects = objects.filter(
+                self.beyond(cursor[1], cursor[2], descending))
+        prefix = '-' if descending else ''
+        objects = objects.order_by(prefix + self.key, prefix + 'pk')
+
+        if limit:
+            objects = list(objects[:limit + 1])
+            more = len(objects) > limit
+            objects = objects[:limit]
+        else:
+            objects = list(objects)
+            more = False
+        if not forwards:
+            objects.reverse()
+
+        meta = {
+            'limit': limit,
+            'previous': None,
+            'next': None,
+        }
+        # Counting costs as much as the whole archive is big, so only the
+        # first page pays for it.
+        if cursor is None:
+            meta['total_count'] = self.get_count()
+        if forwards:
+            has_previous, has_next = cursor is not None, more
+        else:
+            has_previous, has_next = more, True
+        if objects and has_previous:
+            meta['previous'] = self._generate_cursor_uri(
+                limit, 'p', objects[0])
+        if objects and has_next:
+            meta['next'] = self._generate_cursor_uri(limit, 'n', objects[-1])
+
+        return {
+            self.collection_name: objects,
+            'meta': meta,
+        }
+
+    def is_descending(self):
+        '''Page in the direction the queryset was sorted in, newest first
+        if it wasn't.'''
+        order_by = list(self.objects.query.order_by)
+        if order_by and order_by[0].lstrip('-') == self.key:
+            return order_by[0].startswith('-')
+        return True
+
+    def beyond(self, value, pk, descending):
+        '''Q for the rows that come after (value, pk) in the ordering.'''
+        op = 'lt' if descending else 'gt'
+        return (Q(**{'%s__%s' % (self.key, op): value}) |
+                Q(**{self.key: value, 'pk__%s' % op: pk}))
+
+    def get_value(self, obj):
+        for attr in self.key.split('__'):
+            obj = getattr(obj, attr)
+        return obj
+
+    def get_cursor(self):
+        '''Decode the cursor parameter into (direction, published, pk).'''
+        cursor = self.request_data.get(self.cursor_param)
+        if not cursor:
+            return None
+        try:
+            direction, value, pk = base64.urlsafe_b64decode(
+                str(cursor)).split('|')
+            if direction not in ('n', 'p'):
+                raise ValueError(direction)
+            if '.' in value:
+                value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+            else:
+                value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+            return direction, value, int(pk)
+        except (TypeError, ValueError):
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+
+    def encode_cursor(self, direction, obj):
+        return base64.urlsafe_b64encode('|'.join(
+            [direction, self.get_value(obj).isoformat(), str(obj.pk)]))
+
+    def _generate_cursor_uri(self, limit, direction, obj):
+        if self.resource_uri is None:
+            return None
+
+        request_params = self.request_data.copy()
+        for param in ('limit', 'offset', self.cursor_param):
+            if param in request_params:
+                del request_params[param]
+        request_params.update({
+            'limit': limit,
+            self.cursor_param: self.encode_cursor(direction, obj),
+        })
+        return '%s?%s' % (self.resource_uri, request_params.urlencode())
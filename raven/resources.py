@@ -1,13 +1,28 @@
+import base64
 import json
+import time
 
+from django.conf.urls import url
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import router
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified, QueryDict
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+import dateutil.parser
+import dateutil.tz
 from tastypie import fields
 from tastypie.authentication import SessionAuthentication
 from tastypie.authorization import Authorization
-from tastypie.exceptions import InvalidSortError
-from tastypie.resources import ALL, ALL_WITH_RELATIONS, ModelResource
+from tastypie.exceptions import (
+    BadRequest, ImmediateHttpResponse, InvalidSortError)
+from tastypie.paginator import Paginator
+from tastypie.resources import (
+    ALL, ALL_WITH_RELATIONS, ModelResource, Resource)
+from tastypie.utils import trailing_slash
 
-from raven import models
+from raven import models, viewcache, writebehind
+from raven.paginator import CursorPaginator
 
 
 def _feed_filter(bundle):
@@ -19,7 +34,109 @@ def _feed_filter(bundle):
     return items
 
 
-class FeedResource09(ModelResource):
+class FlushOnReadMixin(object):
+    '''Flush the user's buffered read/starred changes before serving any
+    GET, so they always see their own writes. See raven.writebehind.'''
+
+    def dispatch(self, request_type, request, **kwargs):
+        if request.method == 'GET' and request.user.is_authenticated():
+            writebehind.flush(request.user.pk)
+        return super(FlushOnReadMixin, self).dispatch(
+            request_type, request, **kwargs)
+
+
+class CachedListMixin(object):
+    '''Make list GETs cheap to repeat. Goes after FlushOnReadMixin, so
+    the version it works from includes the user's own buffered writes.
+
+    Each page gets a weak ETag from the user's version, the query string,
+    the format and the time to within RAVEN_VIEW_CACHE_TIMEOUT, and a
+    matching If-None-Match is answered with a 304
+    before the list is queried. Otherwise the page is served from
+    raven.viewcache, so it is only rebuilt once the user has changed
+    something. With the view cache off, pages get no ETag at all.
+    '''
+
+    def dispatch(self, request_type, request, **kwargs):
+        if (request_type != 'list' or request.method != 'GET' or
+                not request.user.is_authenticated() or
+                not viewcache.enabled()):
+            return super(CachedListMixin, self).dispatch(
+                request_type, request, **kwargs)
+
+        user_id = request.user.pk
+        name = '%s:%s' % (self._meta.api_name, self._meta.resource_name)
+        parts = (sorted(request.GET.lists()), self.determine_format(request))
+        version = viewcache.current_version(user_id)
+        # Everything on these pages advances the version, but the odd
+        # change that slips past it (a rebuilt unread count, say) still
+        # shows up within a cache timeout.
+        etag = viewcache.etag(user_id, name, version, parts + (
+            int(time.time() // viewcache.timeout()),))
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if if_none_match.strip() == '*' or etag in parse_etags(
+                if_none_match):
+            response = HttpResponseNotModified()
+        else:
+            responses = []
+
+            def build():
+                response = super(CachedListMixin, self).dispatch(
+                    request_type, request, **kwargs)
+                responses.append(response)
+                if response.status_code == 200:
+                    return (response.content, response['Content-Type'])
+
+            cached = viewcache.get_or_set(
+                user_id, name, build, parts, version=version)
+            if responses:
+                response = responses[0]
+            else:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+            if response.status_code != 200:
+                return response
+
+        response['ETag'] = 'W/' + quote_etag(etag)
+        # Private to the user, and always checked with us before reuse.
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class SparseFieldsMixin(object):
+    '''Honour a fields=a,b,c query parameter by sending only those fields,
+    plus id and resource_uri, which clients need to write anything back.
+
+    Resources can ask wants() whether a field was asked for, so they don't
+    fetch or compute what won't be sent.
+    '''
+    always_fields = ('id', 'resource_uri')
+
+    def requested_fields(self, request):
+        '''The set of fields asked for, or None for all of them.'''
+        fields = request.GET.get('fields') if request is not None else None
+        if not fields:
+            return None
+        fields = set(field.strip() for field in fields.split(','))
+        return (fields - set([''])) | set(self.always_fields)
+
+    def wants(self, request, field):
+        fields = self.requested_fields(request)
+        return fields is None or field in fields
+
+    def full_dehydrate(self, bundle, for_list=False):
+        bundle = super(SparseFieldsMixin, self).full_dehydrate(
+            bundle, for_list)
+        fields = self.requested_fields(bundle.request)
+        if fields is not None:
+            for field in bundle.data.keys():
+                if field not in fields:
+                    del bundle.data[field]
+        return bundle
+
+
+class FeedResource09(FlushOnReadMixin, ModelResource):
     '''A resource representing Feeds.'''
     class Meta:
         allowed_methods = ('get', 'post', 'delete',)
@@ -64,7 +181,7 @@ class FeedResource09(ModelResource):
         feed.remove_subscriber(bundle.request.user)
 
 
-class FeedItemResource09(ModelResource):
+class FeedItemResource09(FlushOnReadMixin, ModelResource):
     '''A resource representing FeedItems.'''
     class Meta:
         allowed_methods = ('get', 'put',)
@@ -82,6 +199,7 @@ class FeedItemResource09(ModelResource):
         resource_name = 'item'
 
     feed = fields.ForeignKey(FeedResource09, 'feed', full=True)
+    description = fields.CharField(attribute='description')
     read = fields.BooleanField()
 
     def get_object_list(self, request):
@@ -94,7 +212,8 @@ class FeedItemResource09(ModelResource):
             user=request.user,
             read=False)
         return models.FeedItem.objects.filter(
-            userfeeditems__in=userfeeditems).order_by('-published')
+            userfeeditems__in=userfeeditems).select_related(
+                'content').order_by('-published')
 
     def obj_get(self, bundle=None, request=None, **kwargs):
         bundle.obj = models.FeedItem.objects.get(pk=kwargs['pk'])
@@ -105,7 +224,8 @@ class FeedItemResource09(ModelResource):
         bundle.obj = models.FeedItem.objects.get(pk=kwargs['pk'])
         userfeeditem = bundle.obj.userfeeditem(bundle.request.user)
         userfeeditem.read = bundle.data['read']
-        userfeeditem.save()
+        if not writebehind.buffer(userfeeditem):
+            userfeeditem.save()
         return bundle
 
     def dehydrate_read(self, bundle):
@@ -113,16 +233,20 @@ class FeedItemResource09(ModelResource):
         return userfeeditem.read
 
 
-class UserFeedResource(ModelResource):
+class UserFeedResource(
+        FlushOnReadMixin, CachedListMixin, SparseFieldsMixin, ModelResource):
     '''A resource describing raven.models.UserFeed.'''
     class Meta:
         always_return_data = True
         authentication = SessionAuthentication()
         authorization = Authorization()
+        excludes = ['seq']
         queryset = models.UserFeed.objects.all()
         resource_name = 'feed'
         max_limit = 20
 
+    unread = fields.IntegerField(attribute='unread', readonly=True)
+
     def build_filters(self, filters=None):
         # This is probably not the right way to do this, but it *seems*
         # performant, and it does what we want.
@@ -148,8 +272,11 @@ class UserFeedResource(ModelResource):
         return semi_filtered
 
     def get_object_list(self, request):
-        return super(UserFeedResource, self).get_object_list(request).filter(
-            user=request.user.pk)
+        objects = super(UserFeedResource, self).get_object_list(
+            request).filter(user=request.user.pk).select_related('feed')
+        if not self.wants(request, 'description'):
+            objects = objects.defer('feed__description')
+        return objects
 
     def obj_create(self, bundle=None, **kwargs):
         data = json.loads(bundle.request.body)
@@ -172,26 +299,31 @@ class UserFeedResource(ModelResource):
         return bundle
 
     def dehydrate(self, bundle):
-        bundle.data['description'] = bundle.obj.feed.description
+        if self.wants(bundle.request, 'description'):
+            bundle.data['description'] = bundle.obj.feed.description
         bundle.data['link'] = bundle.obj.feed.link
         bundle.data['title'] = bundle.obj.feed.title
 
-        bundle.data['tags'] = [tag.name for tag in bundle.obj.tags.all()]
+        if self.wants(bundle.request, 'tags'):
+            bundle.data['tags'] = [tag.name for tag in bundle.obj.tags.all()]
         return bundle
 
 
-class UserFeedItemResource(ModelResource):
+class UserFeedItemResource(
+        FlushOnReadMixin, CachedListMixin, SparseFieldsMixin, ModelResource):
     '''A resource describing raven.models.UserFeedItem.'''
     class Meta:
         authentication = SessionAuthentication()
         authorization = Authorization()
+        excludes = ['seq']
         filtering = {
             'feed': ALL_WITH_RELATIONS,
             'read': ALL,
             'starred': ALL,
         }
         max_limit = 20
-        ordering = ('item__published',)
+        ordering = ('published',)
+        paginator_class = CursorPaginator
         queryset = models.UserFeedItem.objects.all()
         resource_name = 'item'
 
@@ -241,19 +373,13 @@ class UserFeedItemResource(ModelResource):
         return semi_filtered
 
     def apply_sorting(self, obj_list, options=None):
-        '''Workaround: we don't want to expose the implementation detail that
-        we're returning UserFeedItems but ordering on FeedItem.published, so
-        we do this seemingly hacky but also very clever thing. It's less of a
-        hack because I'm totally documenting it.
+        '''Only published ordering is allowed. UserFeedItem carries its own
+        copy of FeedItem.published, so this doesn't need the join.
         '''
         custom_ordering = None
         if 'order_by' in options:
             custom_ordering = options.get('order_by')
-            if custom_ordering == 'published':
-                custom_ordering = 'item__published'
-            elif custom_ordering == '-published':
-                custom_ordering = '-item__published'
-            else:
+            if custom_ordering not in ('published', '-published'):
                 raise InvalidSortError(
                     "The '%s' field does not allow ordering." % custom_ordering)
 
@@ -264,21 +390,349 @@ class UserFeedItemResource(ModelResource):
         return qs
 
     def get_object_list(self, request):
-        return super(UserFeedItemResource, self).get_object_list(request).filter(
-            user=request.user.pk)
+        # A second select_related() call replaces the first in this
+        # Django, so name everything at once.
+        related = ['item', 'feed']
+        if self.wants(request, 'description'):
+            related.append('item__content')
+        return super(UserFeedItemResource, self).get_object_list(
+            request).filter(user=request.user.pk).select_related(
+                *related).defer('feed__description')
+
+    def prepend_urls(self):
+        return [
+            url(r'^(?P<resource_name>%s)/mark_read%s$' % (
+                self._meta.resource_name, trailing_slash()),
+                self.wrap_view('mark_read'), name='api_mark_read'),
+            url(r'^(?P<resource_name>%s)/search%s$' % (
+                self._meta.resource_name, trailing_slash()),
+                self.wrap_view('search'), name='api_search'),
+        ]
+
+    def mark_read(self, request, **kwargs):
+        '''POST to item/mark_read/ to mark many items read at once.
+
+        The body picks what to mark: 'feed' (a UserFeed id), 'tag' (a feed
+        tag), 'all', and/or 'before' (a timestamp; only items published
+        before it). Responds with the number of items marked, in total
+        and per UserFeed id.
+        '''
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        # Anything still buffered predates this, so must land first.
+        writebehind.flush(request.user.pk)
+
+        data = self.deserialize(
+            request, request.body,
+            format=request.META.get('CONTENT_TYPE', 'application/json'))
+        user = request.user
+        userfeeds = models.UserFeed.objects.filter(user=user)
+
+        feeds = None
+        if 'feed' in data:
+            feeds = userfeeds.filter(pk=data['feed']).values('feed')
+        elif 'tag' in data:
+            feeds = userfeeds.filter(tags__name=data['tag']).values('feed')
+        elif not data.get('all') and 'before' not in data:
+            raise BadRequest(
+                "Say which items to mark read with 'feed', 'tag', 'all' "
+                "or 'before'.")
+
+        before = None
+        if 'before' in data:
+            try:
+                before = dateutil.parser.parse(data['before'])
+            except (TypeError, ValueError):
+                raise BadRequest(
+                    "Invalid timestamp '%s' provided." % data['before'])
+            # published is stored as naive UTC.
+            if before.tzinfo is not None:
+                before = before.astimezone(
+                    dateutil.tz.tzutc()).replace(tzinfo=None)
+
+        counts = models.UserFeedItem.mark_read(user, feeds, before)
+        marked = dict(
+            (userfeed.pk, counts[userfeed.feed_id]) for userfeed in
+            userfeeds.filter(feed__in=counts.keys()))
+        self.log_throttled_access(request)
+        return self.create_response(request, {
+            'count': sum(counts.values()),
+            'feeds': marked,
+        })
+
+    def search(self, request, **kwargs):
+        '''GET item/search/?q=... to search the user's items, best matches
+        first. Only the newest matches are ranked; see
+        UserFeedItem.search().
+
+        Narrow it down with 'feed' (a UserFeed id), 'tag' (a feed tag),
+        'tags' (item tags, comma separated), 'read' and 'starred'. Results
+        are paged by limit and offset, since they aren't in published
+        order.
+        '''
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        writebehind.flush(request.user.pk)
+
+        query = request.GET.get('q', '').strip()
+        if not query:
+            raise BadRequest("Say what to search for with 'q'.")
+        objects = self.get_object_list(request)
+        userfeeds = models.UserFeed.objects.filter(user=request.user)
+        if 'feed' in request.GET:
+            try:
+                feed = int(request.GET['feed'])
+            except ValueError:
+                raise BadRequest(
+                    "Invalid feed '%s' provided." % request.GET['feed'])
+            objects = objects.filter(feed__in=userfeeds.filter(
+                pk=feed).values('feed'))
+        if 'tag' in request.GET:
+            objects = objects.filter(feed__in=userfeeds.filter(
+                tags__name=request.GET['tag']).values('feed'))
+        if 'tags' in request.GET:
+            # Through a subquery, so items with several of the tags don't
+            # come back once for each.
+            objects = objects.filter(
+                pk__in=models.TaggedUserFeedItem.objects.filter(
+                    tag__name__in=request.GET['tags'].split(',')
+                ).values('content_object'))
+        for field in ('read', 'starred'):
+            if field in request.GET:
+                objects = objects.filter(**{
+                    field: request.GET[field].lower() in ('true', '1')})
+        objects = models.UserFeedItem.search(objects, query)
+
+        to_be_serialized = self.paginate(
+            request, objects, paginator_class=Paginator, url_name='api_search')
+        self.log_throttled_access(request)
+        return self.create_response(request, to_be_serialized)
+
+    def get_list(self, request, **kwargs):
+        '''Tastypie's get_list(), paginated by paginate().'''
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(
+            bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        sorted_objects = self.apply_sorting(objects, options=request.GET)
+        return self.create_response(
+            request, self.paginate(request, sorted_objects))
+
+    def paginate(self, request, objects, params=None, paginator_class=None,
+                 url_name='api_dispatch_list'):
+        '''Page objects by params (request.GET by default) as get_list()
+        does, plus a call to prefetch() between paginating and
+        dehydrating, so a page costs the same number of queries however
+        many items are on it.
+        '''
+        if params is None:
+            params = request.GET
+        paginator_class = paginator_class or self._meta.paginator_class
+        paginator = paginator_class(
+            params, objects,
+            resource_uri=self.get_resource_uri(url_name=url_name),
+            limit=self._meta.limit, max_limit=self._meta.max_limit,
+            collection_name=self._meta.collection_name)
+        to_be_serialized = paginator.page()
+
+        objects = list(to_be_serialized[self._meta.collection_name])
+        self.prefetch(request, objects)
+
+        bundles = []
+        for obj in objects:
+            bundle = self.build_bundle(obj=obj, request=request)
+            bundles.append(self.full_dehydrate(bundle))
+
+        to_be_serialized[self._meta.collection_name] = bundles
+        return self.alter_list_data_to_serialize(request, to_be_serialized)
+
+    def first_page(self, request):
+        '''The page the reader opens on, unread items newest first, as
+        the list endpoint would return it.'''
+        params = QueryDict('read=false&order_by=-published')
+        objects = self.apply_sorting(
+            self.get_object_list(request).filter(read=False), options=params)
+        return self.paginate(request, objects, params)
+
+    def save(self, bundle, skip_errors=False):
+        '''Save as usual, except that changes to an existing item's read
+        and starred state alone go through the write-behind buffer, once
+        they have been validated and authorized like any other save.'''
+        if bundle.obj.pk is None or not writebehind.enabled():
+            return super(UserFeedItemResource, self).save(bundle, skip_errors)
+
+        self.is_valid(bundle)
+        if bundle.errors and not skip_errors:
+            raise ImmediateHttpResponse(
+                response=self.error_response(bundle.request, bundle.errors))
+        self.authorized_update_detail(
+            self.get_object_list(bundle.request), bundle)
+
+        state = models.UserFeedItem.STATE_FIELDS
+        if (bundle.obj.changed_fields() <= set(state) and
+                writebehind.buffer(bundle.obj)):
+            return bundle
+
+        # Anything else is written straight away, after whatever is
+        # buffered, so nothing buffered can land on top of it later.
+        if writebehind.flush(bundle.obj.user_id):
+            bundle.obj.refresh_state()
+        return super(UserFeedItemResource, self).save(bundle, skip_errors)
+
+    def prefetch(self, request, userfeeditems):
+        '''Look up everything dehydrate() needs for a page of items in
+        bulk: the user's UserFeeds for them, and both sets of tags, skipping
+        whatever fields= left out.'''
+        userfeeds = {}
+        if self.wants(request, 'feed_id') or self.wants(request, 'feed_tags'):
+            userfeeds = dict(
+                (userfeed.feed_id, userfeed) for userfeed in
+                models.UserFeed.objects.filter(
+                    user=request.user.pk,
+                    feed__in=set(obj.feed_id for obj in userfeeditems)))
+        feed_tags = {}
+        if self.wants(request, 'feed_tags'):
+            feed_tags = models.tags_by_object(
+                models.UserFeed,
+                [userfeed.pk for userfeed in userfeeds.values()])
+        tags = {}
+        if self.wants(request, 'tags'):
+            tags = models.tags_by_object(
+                models.UserFeedItem, [obj.pk for obj in userfeeditems])
+
+        for obj in userfeeditems:
+            obj._userfeed = userfeeds.get(obj.feed_id)
+            obj._tag_names = [tag.name for tag in tags.get(obj.pk, [])]
+            if obj._userfeed is not None:
+                obj._userfeed._tag_names = [
+                    tag.name for tag in feed_tags.get(obj._userfeed.pk, [])]
 
     def dehydrate(self, bundle):
-        bundle.data['description'] = bundle.obj.item.description
+        wants = lambda field: self.wants(bundle.request, field)
+        if wants('description'):
+            bundle.data['description'] = bundle.obj.item.description
+        bundle.data['excerpt'] = bundle.obj.item.excerpt
         bundle.data['link'] = bundle.obj.item.link
         bundle.data['published'] = bundle.obj.item.published
         bundle.data['title'] = bundle.obj.item.title
+        bundle.data['word_count'] = bundle.obj.item.word_count
 
-        # Shortcut methods, so we don't need relations.
+        # Shortcut methods, so we don't need relations. On the list path
+        # prefetch() has already looked these up.
         bundle.data['feed_title'] = bundle.obj.feed.title
-        userfeed = models.UserFeed.objects.get(
-            user=bundle.obj.user, feed=bundle.obj.feed)
-        bundle.data['feed_id'] = userfeed.pk
-        bundle.data['feed_tags'] = [tag.name for tag in userfeed.tags.all()]
-
-        bundle.data['tags'] = [tag.name for tag in bundle.obj.tags.all()]
+        if wants('feed_id') or wants('feed_tags'):
+            userfeed = getattr(bundle.obj, '_userfeed', None)
+            if userfeed is None:
+                userfeed = models.UserFeed.objects.get(
+                    user=bundle.obj.user_id, feed=bundle.obj.feed_id)
+            bundle.data['feed_id'] = userfeed.pk
+        if wants('feed_tags'):
+            bundle.data['feed_tags'] = getattr(userfeed, '_tag_names', None)
+            if bundle.data['feed_tags'] is None:
+                bundle.data['feed_tags'] = [
+                    tag.name for tag in userfeed.tags.all()]
+
+        if wants('tags'):
+            bundle.data['tags'] = getattr(bundle.obj, '_tag_names', None)
+            if bundle.data['tags'] is None:
+                bundle.data['tags'] = [
+                    tag.name for tag in bundle.obj.tags.all()]
         return bundle
+
+
+class SyncResource(FlushOnReadMixin, Resource):
+    '''Everything that changed for the user since a sync token.
+
+    GET sync/?token=<token> returns the UserFeedItems added or changed
+    (read, starred, tags), the UserFeeds added or changed, the ids of
+    UserFeeds removed, every feed's unread count, and a new token to pass
+    next time. Without a token it returns just a token for the present,
+    to take after loading everything through the other endpoints.
+
+    Items come at most max_limit at a time; while more is true, call
+    again straight away with the new token. Changes may occasionally be
+    sent twice, never skipped.
+    '''
+    class Meta:
+        allowed_methods = ('get',)
+        authentication = SessionAuthentication()
+        authorization = Authorization()
+        max_limit = 100
+        resource_name = 'sync'
+
+    def dispatch_list(self, request, **kwargs):
+        return self.dispatch('list', request, **kwargs)
+
+    def get_list(self, request, **kwargs):
+        user = request.user
+        # Before reading anything, so nothing it covers can be missed.
+        horizon = models.UserSequence.horizon(
+            user, using=router.db_for_read(models.UserFeedItem))
+        token = request.GET.get('token')
+        if not token:
+            return self.create_response(request, {
+                'token': self.encode_token(horizon),
+                'more': False,
+                'items': [],
+                'feeds': [],
+                'removed_feeds': [],
+                'unread': {},
+            })
+        since, after = self.decode_token(token)
+
+        item_resource = UserFeedItemResource(api_name=self._meta.api_name)
+        position = Q(seq__gt=since)
+        if after is not None:
+            position = position | Q(seq=since, pk__gt=after)
+        items = list(item_resource.get_object_list(request).filter(
+            position).order_by('seq', 'pk')[:self._meta.max_limit + 1])
+        more = len(items) > self._meta.max_limit
+        items = items[:self._meta.max_limit]
+        if more and items[-1].seq <= horizon:
+            new_token = self.encode_token(items[-1].seq, items[-1].pk)
+        else:
+            # Anything past the horizon may yet be joined by changes from
+            # transactions still running, so it comes again next time.
+            more = False
+            new_token = self.encode_token(max(since, horizon))
+
+        item_resource.prefetch(request, items)
+        feed_resource = UserFeedResource(api_name=self._meta.api_name)
+        feeds = models.UserFeed.objects.filter(
+            user=user, seq__gt=since).select_related('feed')
+        removed = models.Tombstone.objects.filter(
+            user=user, seq__gt=since).values_list('userfeed_id', flat=True)
+        unread = dict(models.UserFeed.objects.filter(
+            user=user).values_list('pk', 'unread'))
+
+        return self.create_response(request, {
+            'token': new_token,
+            'more': more,
+            'items': [
+                item_resource.full_dehydrate(
+                    item_resource.build_bundle(obj=item, request=request))
+                for item in items],
+            'feeds': [
+                feed_resource.full_dehydrate(
+                    feed_resource.build_bundle(obj=feed, request=request))
+                for feed in feeds],
+            'removed_feeds': sorted(set(removed)),
+            'unread': unread,
+        })
+
+    def encode_token(self, seq, pk=None):
+        token = str(seq) if pk is None else '%s:%s' % (seq, pk)
+        return base64.urlsafe_b64encode(token)
+
+    def decode_token(self, token):
+        '''Decode a sync token into (seq, pk), pk being None unless the
+        last response had more.'''
+        try:
+            parts = base64.urlsafe_b64decode(str(token)).split(':')
+            if len(parts) == 1:
+                return int(parts[0]), None
+            seq, pk = parts
+            return int(seq), int(pk)
+        except (TypeError, ValueError):
+            raise BadRequest("Invalid sync token '%s' provided." % token)
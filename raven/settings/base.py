@@ -198,6 +198,47 @@ SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 API_LIMIT_PER_PAGE = 0
 
+# Feed fetching. Each update_feeds batch downloads up to
+# RAVEN_FETCH_CONCURRENCY feeds at once, giving up on any single host
+# after RAVEN_FETCH_TIMEOUT seconds. Set the concurrency to 1 to fetch
+# serially.
+RAVEN_FETCH_CONCURRENCY = 10
+RAVEN_FETCH_TIMEOUT = 30
+
+# Feed scheduling. Every minute the scheduler claims up to
+# RAVEN_FETCH_BATCHES batches of RAVEN_FETCH_BATCH_SIZE due feeds, so
+# set RAVEN_FETCH_BATCHES to roughly the number of worker processes.
+RAVEN_FETCH_BATCH_SIZE = 50
+RAVEN_FETCH_BATCHES = 4
+
+# Buffer read/starred changes from the API and write them out in batches;
+# see raven.writebehind. Needs a cache shared by every process. Changes
+# are flushed after RAVEN_WRITE_BEHIND_DELAY seconds or once a user has
+# RAVEN_WRITE_BEHIND_MAX of them, whichever comes first.
+RAVEN_WRITE_BEHIND = False
+RAVEN_WRITE_BEHIND_DELAY = 10
+RAVEN_WRITE_BEHIND_MAX = 100
+
+# The default cache holds the write-behind buffer and raven.viewcache's
+# per-user pages. Set MEMCACHE_SERVERS (host:port;host:port) to share it
+# between processes, which RAVEN_WRITE_BEHIND needs, and CACHE_BACKEND
+# to use another memcached-compatible backend. Cached pages live for up
+# to RAVEN_VIEW_CACHE_TIMEOUT seconds; 0 turns them off.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+if os.environ.get('MEMCACHE_SERVERS'):
+    CACHES['default'] = {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.memcached.MemcachedCache'),
+        'LOCATION': os.environ['MEMCACHE_SERVERS'].split(';'),
+    }
+RAVEN_VIEW_CACHE = 'default'
+RAVEN_VIEW_CACHE_TIMEOUT = 5 * 60
+
 # django-push setting, use https for callback urls
 PUSH_SSL_CALLBACK = True
 
@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+
+# Sent once for each batch of FeedItems that a fetch or an import actually
+# created, never for updates to existing items. sender is the Feed, items
+# is the list of new FeedItems, and mark_as_read (optional, default False)
+# says whether subscribers should get them already read.
+items_created = Signal(providing_args=['items', 'mark_as_read'])
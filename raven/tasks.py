@@ -1,17 +1,23 @@
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 import logging
 import os
+import time
 import zipfile
 
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.storage import default_storage
+from django.db import router
 
 from celery.task import task, Task, PeriodicTask
 from libgreader import ClientAuthMethod, OAuth2Method, GoogleReader
 import json
 import opml
 
+from raven import writebehind
 from raven.models import Feed, FeedItem, UserFeedItem
+from raven.signals import items_created
 
 logger = logging.getLogger('django')
 
@@ -28,73 +34,129 @@ class FakeEntry(object):
         self.content = item['content']
         self.time = item['time']
 
-def _new_user_item(user, feed, entry):
-    try:
-        item = FeedItem.objects.get(reader_guid=entry.id)
-    except ObjectDoesNotExist:
-        tmp = FeedItem()
-        tmp.feed = feed
-        tmp.title = entry.title
-        tmp.link = entry.url
-        tmp.atom_id = ''
+def _new_user_items(user, entries):
+    '''Import Reader entries, given as (feed, entry) pairs, for user.
+
+    Returns user's UserFeedItems for them, in the same order.
+    '''
+    user_items = []
+    for i in xrange(0, len(entries), UserFeedItem.BATCH_SIZE):
+        user_items.extend(
+            _new_user_item_batch(user, entries[i:i + UserFeedItem.BATCH_SIZE]))
+    return user_items
+
+def _new_user_item_batch(user, entries):
+    # Items are matched and created a feed at a time, and the new ones
+    # handed out to each feed's subscribers in one go, as Feed.update()
+    # does.
+    known = dict(
+        (item.reader_guid, item) for item in FeedItem.objects.filter(
+            reader_guid__in=[entry.id for feed, entry in entries]))
+    by_feed = {}
+    for i, (feed, entry) in enumerate(entries):
+        by_feed.setdefault(feed.pk, (feed, []))[1].append(i)
+
+    items = [None] * len(entries)
+    for feed, indexes in by_feed.values():
+        tmps = []
+        for i in indexes:
+            entry = entries[i][1]
+            if entry.id in known:
+                items[i] = known[entry.id]
+                continue
+            tmp = FeedItem()
+            tmp.feed = feed
+            tmp.title = entry.title
+            tmp.link = entry.url
+            tmp.atom_id = ''
+
+            tmp.description = entry.content
+            tmp.reader_guid = entry.id
+            tmp.published = datetime.utcfromtimestamp(entry.time)
+            tmp.guid = tmp.calculate_guid()
+            tmps.append((i, tmp))
+
+        results = FeedItem.bulk_get_or_create(feed, [tmp for i, tmp in tmps])
+        created = []
+        for (i, tmp), (item, new) in zip(tmps, results):
+            items[i] = item
+            if new:
+                created.append(item)
+        if created:
+            items_created.send(sender=feed, items=created)
+
+    # Read back from where add_to_users() just wrote.
+    db = router.db_for_write(UserFeedItem)
+    user_items = dict(
+        (user_item.item_id, user_item) for user_item in
+        UserFeedItem.objects.using(db).filter(
+            user=user, item__in=set(item.pk for item in items)))
+    result = []
+    for (feed, entry), item in zip(entries, items):
+        user_item = user_items.get(item.pk)
+        if user_item is None:
+            # Nasty. The above only works if a user is actually
+            # subscribed to a feed. However, it can be the case
+            # where we're trying to import Google Reader, and we're
+            # processing items that have been shared with us. In
+            # this case, we probably won't be subscribed to the
+            # feed, and more, we probably don't want to subscribe to
+            # the feed. So manually create a UserFeedItem so the
+            # Item can be accessed by the User. We can pull it out
+            # of the db later by searching for the 'shared-with-you'
+            # tag.
+            user_item = UserFeedItem()
+            user_item.item = item
+            user_item.user = user
+            user_item.feed = feed
+            user_items[item.pk] = user_item
+
+        user_item.read = entry.read
+        user_item.starred = entry.starred
+        user_item.save()
+        for t in entry.tags:
+            user_item.tags.add(t)
+        result.append(user_item)
+    return result
 
-        tmp.description = entry.content
-        tmp.reader_guid = entry.id
-        tmp.published = datetime.utcfromtimestamp(entry.time)
-        tmp.guid = tmp.calculate_guid()
+def _fetch_all(feeds):
+    '''Download a batch of feeds concurrently.
 
-        item = FeedItem._get_or_create(tmp)
+    Returns a dict of feed pk => feedparser result. Fetching is almost
+    entirely waiting on sockets, so a small thread pool gets through a
+    batch of slow hosts in roughly the time of the slowest one.
+    '''
+    concurrency = getattr(settings, 'RAVEN_FETCH_CONCURRENCY', 10)
+    timeout = getattr(settings, 'RAVEN_FETCH_TIMEOUT', 30)
 
-    try:
-        user_item = item.userfeeditem(user)
-    except ObjectDoesNotExist:
-        # Nasty. The above only works if a user is actually
-        # subscribed to a feed. However, it can be the case
-        # where we're trying to import Google Reader, and we're
-        # processing items that have been shared with us. In
-        # this case, we probably won't be subscribed to the
-        # feed, and more, we probably don't want to subscribe to
-        # the feed. So manually create a UserFeedItem so the
-        # Item can be accessed by the User. We can pull it out
-        # of the db later by searching for the 'shared-with-you'
-        # tag.
-        user_item = UserFeedItem()
-        user_item.item = item
-        user_item.user = user
-        user_item.feed = feed
-        user_item.save()
+    def fetch(feed):
+        return feed.pk, feed.fetch(timeout=timeout)
 
-    user_item.read = entry.read
-    user_item.starred = entry.starred
-    for t in entry.tags:
-        user_item.tags.add(t)
-    user_item.save()
+    if concurrency <= 1 or len(feeds) <= 1:
+        return dict(fetch(feed) for feed in feeds)
 
-    return user_item
+    pool = ThreadPool(min(concurrency, len(feeds)))
+    try:
+        return dict(pool.map(fetch, feeds))
+    finally:
+        pool.close()
+        pool.join()
 
 @task
 def update_feeds(feeds, *args, **kwargs):
-    logger.warn('Celery heartbeat (2/2): freq %d' % (feeds[0].fetch_frequency))
-    for feed in feeds:
-        feed.update(hack=kwargs.get('hack', False))
+    feeds = list(feeds)
+    if not feeds:
+        return
+    logger.warn('Celery heartbeat (2/2): %d feeds' % len(feeds))
 
-class UpdateFeedBeat(PeriodicTask):
-    '''A task for updating a set of feeds.'''
-
-    SLICE_SIZE = 150
-    run_every = timedelta(seconds=60*10)
-
-    def run(self):
-        for freq in [Feed.FETCH_FAST, Feed.FETCH_DEFAULT, Feed.FETCH_SLOW]:
-            age = datetime.utcnow() - timedelta(minutes=freq)
-            feeds = Feed.objects.filter(last_fetched__lt=age,
-                                        fetch_frequency=freq).order_by('last_fetched')[:self.SLICE_SIZE]
-            update_feeds.apply_async([feeds])
-            logger.warn('Celery heartbeat (1/2): freq %d' % (freq))
+    start = time.time()
+    fetched = _fetch_all([feed for feed in feeds if feed.should_fetch()])
+    fetch_time = time.time() - start
 
+    # Parsing and storing stay serial; they're all database work.
+    for feed in feeds:
         # If we imported feeds + feeditems from Reader, we have
-        # never marked them as fetched. So we find them here and
-        # fetch them for the first time. But as feedparser goes out
+        # never marked them as fetched. But as feedparser goes out
         # and grabs feeds, there is absolutely no way to map those
         # feeditems to the ones we've already grabbed from Reader.
         #
@@ -109,8 +171,74 @@ class UpdateFeedBeat(PeriodicTask):
         # as read.
         #
         # Wow.
-        never_fetched = Feed.objects.filter(last_fetched=None)
-        update_feeds.apply_async([never_fetched], { 'hack' : True })
+        hack = kwargs.get('hack', feed.last_fetched is None)
+        feed.update(data=fetched.get(feed.pk), hack=hack)
+    total_time = time.time() - start
+
+    logger.warn('Fetched %d/%d feeds in %.2fs (%.2fs total, concurrency %d)' % (
+        len(fetched), len(feeds), fetch_time, total_time,
+        getattr(settings, 'RAVEN_FETCH_CONCURRENCY', 10)))
+
+class UpdateFeedBeat(PeriodicTask):
+    '''A task for handing due feeds out to the workers.
+
+    Every tick claims the feeds whose next_fetch_at has passed, most
+    overdue first, and splits them into update_feeds batches. Claimed
+    feeds have next_fetch_at pushed out by CLAIM_LEASE so no other tick
+    hands them out again while a worker still has them (see claim());
+    Feed.update() then reschedules them properly.
+    '''
+
+    CLAIM_LEASE = timedelta(minutes=30)
+    run_every = timedelta(seconds=60)
+
+    def run(self):
+        batch_size = getattr(settings, 'RAVEN_FETCH_BATCH_SIZE', 50)
+        batches = getattr(settings, 'RAVEN_FETCH_BATCHES', 4)
+
+        now = datetime.utcnow()
+        feeds = self.claim(list(Feed.objects.filter(
+            next_fetch_at__lte=now).order_by(
+                'next_fetch_at')[:batch_size * batches]), now)
+        if not feeds:
+            return
+
+        for i in xrange(0, len(feeds), batch_size):
+            update_feeds.apply_async([feeds[i:i + batch_size]])
+        logger.warn('Celery heartbeat (1/2): %d feeds, most overdue %s' % (
+            len(feeds), now - feeds[0].next_fetch_at))
+
+    def claim(self, feeds, now):
+        '''Claim those of feeds that are still due at now, returning
+        them.
+
+        The UPDATE only touches feeds still due, and the database
+        rechecks that as it locks each row, so of two overlapping ticks
+        only one gets any given feed. Those it got are the ones now
+        carrying its lease, which is unique to the tick.
+        '''
+        if not feeds:
+            return []
+        db = router.db_for_write(Feed)
+        pks = [feed.pk for feed in feeds]
+        lease = now + self.CLAIM_LEASE
+        Feed.objects.using(db).filter(
+            pk__in=pks, next_fetch_at__lte=now).update(next_fetch_at=lease)
+        claimed = set(Feed.objects.using(db).filter(
+            pk__in=pks, next_fetch_at=lease).values_list('pk', flat=True))
+        return [feed for feed in feeds if feed.pk in claimed]
+
+class FlushReadStateBeat(PeriodicTask):
+    '''Write out read/starred changes sitting in the write-behind buffer.
+
+    Does nothing unless RAVEN_WRITE_BEHIND is on. See raven.writebehind.
+    '''
+
+    run_every = timedelta(seconds=10)
+
+    def run(self):
+        if writebehind.enabled():
+            writebehind.flush_dirty()
 
 class EatTakeoutTask(Task):
     '''A task for processing a Google Takeout file.'''
@@ -168,6 +296,7 @@ class EatTakeoutTask(Task):
         except KeyError:
             return False
 
+        entries = []
         for i in data['items']:
             title = i['origin']['title']
             site = i['origin']['htmlUrl']
@@ -196,9 +325,10 @@ class EatTakeoutTask(Task):
                     # No idea if this is even possible, we should squawk
                     item['content'] = ''
             item['time'] = i['published']
-            entry = FakeEntry(item)
-            user_item = _new_user_item(self.user, feed, entry)
+            entries.append((feed, FakeEntry(item)))
 
+        user_items = _new_user_items(self.user, entries)
+        for i, user_item in zip(data['items'], user_items):
             for c in i.get('categories', []):
                 if c.startswith('user/') and c.endswith('/like'):
                     user_item.tags.add('liked')
@@ -305,10 +435,8 @@ class SyncFromReaderAPITask(Task):
             feed = feeds[f.feedUrl]
 
             f.loadItems(loadLimit=loadLimit)
-            for e in f.items:
-                if e.url is None:
-                    continue
-                _new_user_item(user, feed, e)
+            _new_user_items(
+                user, [(feed, e) for e in f.items if e.url is not None])
 
         # Finally, import the special items
         reader.makeSpecialFeeds()
@@ -318,6 +446,7 @@ class SyncFromReaderAPITask(Task):
         for sf in special:
             f = reader.specialFeeds[sf]
             f.loadItems(loadLimit=1000)
+            entries = []
             for e in f.items:
                 try:
                     feed = feeds[e.feed.feedUrl]
@@ -330,9 +459,9 @@ class SyncFromReaderAPITask(Task):
                             link = e.feed.feedUrl
                         feed = Feed.create_raw(e.feed.title, link, e.feed.siteUrl)
                         feeds[e.feed.feedUrl] = feed
+                entries.append((feed, e))
 
-                user_item = _new_user_item(user, feed, e)
-
+            for user_item in _new_user_items(user, entries):
                 if sf == 'like':
                     user_item.tags.add('imported', 'liked')
                 elif sf == 'post' or sf == 'created':
@@ -1,14 +1,23 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import os
 import time
 import unittest
 
 from django.contrib.auth import get_user_model
 from django.test import TestCase
 from django.test.utils import override_settings
+import feedparser
+import mock
 
-from raven.models import Feed, FeedItem, UserFeed, UserFeedItem
+from raven.fields import digest
+from raven.models import (
+    Feed, FeedItem, FeedItemContent, TaggedUserFeed, TaggedUserFeedItem,
+    UserFeed, UserFeedItem, UserSequence)
 from raven.test_utils import network_available
 
+THIS_DIR = os.path.dirname(__file__)
+TESTDATA_DIR = os.path.join(THIS_DIR, 'testdata')
+
 User = get_user_model()
 
 __all__ = ['FeedTest', 'FeedItemTest', 'UserFeedTest', 'UserFeedItemTest']
@@ -88,6 +97,42 @@ class FeedTest(TestCase):
         self.assertEqual(feed.subscribers.count(), 1)
         self.assertEqual(user.feeditems.count(), 2)
 
+    def test_add_subscriber_archive(self):
+        '''Subscribing to a big archive is one insert; only the newest
+        items come in unread.'''
+        feed = Feed.objects.create(
+            title='BoingBoing', link='http://boingboing.net')
+        now = datetime.utcnow()
+        for i in xrange(25):
+            item = FeedItem(
+                feed=feed, title='Post %d' % i, description='',
+                link='http://boingboing.net/%d' % i,
+                guid='http://boingboing.net/%d' % i,
+                published=now - timedelta(days=i))
+            item.save()
+
+        bob = User.objects.create(email='Bob')
+        # Bob already has the newest post, and has read it.
+        UserFeedItem.objects.create(
+            user=bob, feed=feed, read=True,
+            item=FeedItem.objects.get(title='Post 0'))
+
+        # Two of those are advancing Bob's UserSequence.
+        with self.assertNumQueries(6):
+            feed.add_subscriber(bob)
+
+        items = UserFeedItem.objects.filter(user=bob, feed=feed)
+        self.assertEqual(items.count(), 25)
+        unread = items.filter(read=False).values_list(
+            'item__title', flat=True)
+        self.assertEqual(
+            sorted(unread), sorted('Post %d' % i for i in xrange(1, 10)))
+        self.assertEqual(UserFeed.objects.get(user=bob, feed=feed).unread, 9)
+
+        # Subscribing again changes nothing.
+        feed.add_subscriber(bob)
+        self.assertEqual(items.count(), 25)
+
     def test_duplicates(self):
         '''Ensure that we can't create duplicate feeds using create_and_subscribe()'''
         user = User()
@@ -130,6 +175,103 @@ class FeedTest(TestCase):
         self.assertEqual(feed.title, 'Dapper as...')
         self.assertTrue(feed.description.startswith('Bike rider'))
 
+    def test_update_from_data(self):
+        '''Update from an already-parsed feed, twice.'''
+        user = User.objects.create_user('bob', 'bob@example.com')
+
+        feed = Feed()
+        feed.link = 'http://www.example.com/rss'
+        feed.last_fetched = datetime.utcnow() - timedelta(minutes=31)
+        feed.save()
+        feed.add_subscriber(user)
+
+        data = feedparser.parse(os.path.join(TESTDATA_DIR, 'feed.rss'))
+        feed.update(data=data)
+
+        feed = Feed.objects.get(pk=feed.pk)
+        self.assertEqual(feed.title, 'Example Feed')
+        self.assertEqual(feed.items.count(), 5)
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=user, read=False).count(), 5)
+        self.assertEqual(feed.last_published, datetime(2013, 7, 5, 12))
+
+        # Fetching the same thing again doesn't create anything new, and
+        # doesn't touch the join table at all.
+        feed.last_fetched = datetime.utcnow() - timedelta(minutes=31)
+        feed.save()
+        with mock.patch.object(UserFeedItem, 'add_to_users') as add_to_users:
+            feed.update(data=data)
+        self.assertFalse(add_to_users.called)
+        self.assertEqual(feed.items.count(), 5)
+        self.assertEqual(UserFeedItem.objects.filter(user=user).count(), 5)
+
+    def test_update_not_modified(self):
+        '''A 304 only bumps last_fetched and the fetch stats, and
+        validators are sent back.'''
+        feed = Feed()
+        feed.link = 'http://paulhummer.org/rss'
+        feed.etag = u'"abc123"'
+        feed.modified = u'Thu, 04 Apr 2013 00:00:00 GMT'
+        last_fetched = datetime.utcnow() - timedelta(minutes=31)
+        feed.last_fetched = last_fetched
+        feed.last_published = datetime.utcnow() - timedelta(days=400)
+        feed.save()
+
+        data = feedparser.FeedParserDict(status=304, bozo=0, entries=[])
+        with mock.patch('feedparser.parse', return_value=data) as parse:
+            feed.update()
+        parse.assert_called_once_with(
+            feed.link, etag=u'"abc123"',
+            modified=u'Thu, 04 Apr 2013 00:00:00 GMT')
+
+        feed = Feed.objects.get(pk=feed.pk)
+        self.assertTrue(feed.last_fetched > last_fetched)
+        self.assertEqual(feed.items.count(), 0)
+        self.assertEqual(feed.etag, u'"abc123"')
+        self.assertEqual(feed.fetch_frequency, Feed.FETCH_SLOW)
+
+    def test_calculate_stats(self):
+        '''Fetch frequency comes from rolling stats, not item counts.'''
+        bob = User.objects.create_user('bob', 'bob@example.com')
+        steve = User.objects.create_user('steve', 'steve@example.com')
+
+        feed = Feed()
+        feed.title = 'Firehose'
+        feed.link = 'http://www.example.com/firehose'
+        feed.save()
+        feed.add_subscriber(bob)
+        feed.add_subscriber(steve)
+
+        # A post every 20 minutes is plenty busy.
+        start = datetime.utcnow() - timedelta(hours=10)
+        for i in xrange(0, 30):
+            feed.record_post(start + timedelta(minutes=20 * i))
+        self.assertAlmostEqual(feed.post_interval, 20 * 60)
+        # Already seen, so it doesn't count again.
+        feed.record_post(start)
+        self.assertAlmostEqual(feed.post_interval, 20 * 60)
+
+        with self.assertNumQueries(1):
+            feed.calculate_stats()
+        self.assertEqual(feed.fetch_frequency, Feed.FETCH_FAST)
+
+        # Slowing to a post every 4 hours takes it back to normal.
+        feed.post_interval = 4 * 60 * 60
+        with self.assertNumQueries(0):
+            feed.calculate_stats()
+        self.assertEqual(feed.fetch_frequency, Feed.FETCH_DEFAULT)
+
+        # Quiet for over a year.
+        feed.last_published = datetime.utcnow() - timedelta(days=400)
+        with self.assertNumQueries(0):
+            feed.calculate_stats()
+        self.assertEqual(feed.fetch_frequency, Feed.FETCH_SLOW)
+
+        # And back again.
+        feed.last_published = datetime.utcnow() - timedelta(days=2)
+        feed.calculate_stats()
+        self.assertEqual(feed.fetch_frequency, Feed.FETCH_DEFAULT)
+
     @unittest.skipUnless(network_available(), 'Network unavailable')
     @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
                        CELERY_ALWAYS_EAGER=True,
@@ -345,10 +487,297 @@ class UserFeedTest(TestCase):
         self.assertEqual(tags.count(), 2)
         self.assertEqual([tag.name for tag in tags.all()], ['linux', 'nerd'])
 
+    def test_unread_counter(self):
+        bob = User.objects.create(email='Bob')
+        feed = Feed.objects.create(
+            title='Some Political Bullshit', link='http://bs.com/rss')
+        feed.add_subscriber(bob)
+        userfeed = UserFeed.objects.get(user=bob, feed=feed)
+        self.assertEqual(userfeed.unread_count(), 0)
+
+        for i in xrange(3):
+            item = FeedItem(
+                feed=feed, title='Post %d' % i, description='',
+                link='http://bs.com/%d' % i, guid='http://bs.com/%d' % i,
+                published=datetime.utcnow())
+            item.save()
+        userfeed = UserFeed.objects.get(pk=userfeed.pk)
+        self.assertEqual(userfeed.unread_count(), 3)
+
+        user_item = UserFeedItem.objects.filter(user=bob)[0]
+        user_item.read = True
+        user_item.save()
+        # Saving again without a change leaves the counter alone.
+        user_item.save()
+        self.assertEqual(UserFeed.objects.get(pk=userfeed.pk).unread, 2)
+
+        user_item.read = False
+        user_item.save()
+        UserFeedItem.objects.filter(user=bob)[1].delete()
+        self.assertEqual(UserFeed.objects.get(pk=userfeed.pk).unread, 2)
+
+        UserFeed.objects.filter(pk=userfeed.pk).update(unread=42)
+        UserFeed.recount_unread()
+        self.assertEqual(UserFeed.objects.get(pk=userfeed.pk).unread, 2)
+
+    def _tagged_subscriptions(self, feed, *users):
+        for i in xrange(3):
+            item = FeedItem(
+                feed=feed, title='Post %d' % i, description='',
+                link='http://bs.com/%d' % i, guid='http://bs.com/%d' % i,
+                published=datetime.utcnow())
+            item.save()
+        for user in users:
+            feed.add_subscriber(user)
+            UserFeed.objects.get(user=user, feed=feed).tags.add('politics')
+            for user_item in UserFeedItem.objects.filter(user=user):
+                user_item.tags.add('later')
+
+    def _tag_count(self):
+        return (TaggedUserFeed.objects.count() +
+                TaggedUserFeedItem.objects.count())
+
+    def test_remove_subscriber(self):
+        bob = User.objects.create(email='Bob')
+        steve = User.objects.create(email='Steve')
+        feed = Feed.objects.create(
+            title='Some Political Bullshit', link='http://bs.com/rss')
+        self._tagged_subscriptions(feed, bob, steve)
+        self.assertEqual(self._tag_count(), 8)
+
+        feed.remove_subscriber(bob)
+
+        self.assertEqual(UserFeed.objects.filter(user=bob).count(), 0)
+        self.assertEqual(UserFeedItem.objects.filter(user=bob).count(), 0)
+        self.assertEqual(UserFeedItem.objects.filter(user=steve).count(), 3)
+        # Only Steve's tags are left.
+        self.assertEqual(self._tag_count(), 4)
+
+    def test_feed_changed(self):
+        '''Subscriptions are restamped when what they show of a feed
+        changes, and only then.'''
+        bob = User.objects.create(email='Bob')
+        feed = Feed.objects.create(
+            title='BoingBoing', link='http://boingboing.net')
+        feed.add_subscriber(bob)
+        seq = UserSequence.current(bob)
+
+        feed.last_fetched = datetime.utcnow()
+        feed.save()
+        self.assertEqual(UserSequence.current(bob), seq)
+
+        feed = Feed.objects.get(pk=feed.pk)
+        feed.title = 'Boing Boing'
+        feed.save()
+        self.assertEqual(UserSequence.current(bob), seq + 1)
+        self.assertEqual(UserFeed.objects.get(user=bob).seq, seq + 1)
+
+    def test_advance(self):
+        '''Each advance hands every user the next value of their own
+        sequence, starting them off if they have none.'''
+        bob = User.objects.create(email='Bob')
+        steve = User.objects.create(email='Steve')
+        UserSequence.advance([bob.pk])
+        self.assertEqual(
+            UserSequence.advance([bob.pk, steve.pk, bob.pk]),
+            {bob.pk: 2, steve.pk: 1})
+        self.assertEqual(UserSequence.current(steve), 1)
+
+    def test_delete_user(self):
+        bob = User.objects.create(email='Bob')
+        steve = User.objects.create(email='Steve')
+        feed = Feed.objects.create(
+            title='Some Political Bullshit', link='http://bs.com/rss')
+        self._tagged_subscriptions(feed, bob, steve)
+
+        bob.delete()
+
+        self.assertEqual(UserFeed.objects.count(), 1)
+        self.assertEqual(UserFeedItem.objects.count(), 3)
+        self.assertEqual(self._tag_count(), 4)
+        self.assertEqual(feed.items.count(), 3)
+
 
 class FeedItemTest(TestCase):
     '''Tests for the FeedItem model.'''
 
+    def _tmp(self, feed, i, title=None):
+        tmp = FeedItem()
+        tmp.feed = feed
+        tmp.title = title or u'Post {0}'.format(i)
+        tmp.link = u'http://www.example.com/post/{0}'.format(i)
+        tmp.update_link_hash()
+        tmp.atom_id = u''
+        tmp.description = u'Words.'
+        tmp.published = datetime(2013, 6, 1) + timedelta(days=i)
+        tmp.guid = tmp.calculate_guid()
+        return tmp
+
+    def test_bulk_get_or_create(self):
+        feed = Feed()
+        feed.title = 'BoingBoing'
+        feed.link = 'http://boingboing.net'
+        feed.save()
+
+        tmps = [self._tmp(feed, i) for i in xrange(0, 10)]
+        # One lookup, one insert, one query for the new primary keys and
+        # one insert for their content.
+        with self.assertNumQueries(4):
+            results = FeedItem.bulk_get_or_create(feed, tmps)
+        self.assertEqual(feed.items.count(), 10)
+        self.assertTrue(all(created for item, created in results))
+        self.assertTrue(all(item.pk for item, created in results))
+
+        # Nothing changed, so nothing to write.
+        tmps = [self._tmp(feed, i) for i in xrange(0, 10)]
+        with self.assertNumQueries(1):
+            results = FeedItem.bulk_get_or_create(feed, tmps)
+        self.assertFalse(any(created for item, created in results))
+
+        # One updated (matched on link), one new.
+        tmps = [self._tmp(feed, 0, title=u'Post 0, revised'),
+                self._tmp(feed, 10)]
+        results = FeedItem.bulk_get_or_create(feed, tmps)
+        self.assertEqual([created for item, created in results], [False, True])
+        self.assertEqual(feed.items.count(), 11)
+        self.assertEqual(
+            FeedItem.objects.get(pk=results[0][0].pk).title,
+            u'Post 0, revised')
+
+    def test_excerpt(self):
+        '''Items carry a plain-text excerpt and word count, however they
+        were created.'''
+        feed = Feed()
+        feed.title = 'BoingBoing'
+        feed.link = 'http://boingboing.net'
+        feed.save()
+
+        tmp = self._tmp(feed, 0)
+        tmp.description = u'<p>Fish &amp; <b>chips</b></p>' + u' word' * 60
+        item = FeedItem.bulk_get_or_create(feed, [tmp])[0][0]
+        item = FeedItem.objects.get(pk=item.pk)
+        self.assertEqual(item.word_count, 63)
+        self.assertTrue(item.excerpt.startswith(u'Fish & chips word'))
+        self.assertEqual(len(item.excerpt.split()), FeedItem.EXCERPT_WORDS)
+
+        item.description = u'<p>Shorter.</p>'
+        item.save()
+        item = FeedItem.objects.get(pk=item.pk)
+        self.assertEqual(item.excerpt, u'Shorter.')
+        self.assertEqual(item.word_count, 1)
+
+    def test_description(self):
+        '''The body lives in FeedItemContent, loaded only when used.'''
+        feed = Feed()
+        feed.title = 'BoingBoing'
+        feed.link = 'http://boingboing.net'
+        feed.save()
+
+        item = FeedItem.bulk_get_or_create(feed, [self._tmp(feed, 0)])[0][0]
+        self.assertEqual(
+            FeedItemContent.objects.get(item=item).description, u'Words.')
+
+        item = FeedItem.objects.get(pk=item.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(item.description, u'Words.')
+            self.assertEqual(item.description, u'Words.')
+        item = FeedItem.objects.select_related('content').get(pk=item.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(item.description, u'Words.')
+
+        item.description = u'More words.'
+        item.save()
+        self.assertEqual(
+            FeedItemContent.objects.get(item=item).description,
+            u'More words.')
+
+    def test_digests(self):
+        '''Hashes are 64-bit digests, and a colliding digest doesn't
+        match the wrong item.'''
+        feed = Feed()
+        feed.title = 'BoingBoing'
+        feed.link = 'http://boingboing.net'
+        feed.save()
+
+        first, second = [item for item, created in
+                         FeedItem.bulk_get_or_create(
+                             feed, [self._tmp(feed, 0), self._tmp(feed, 1)])]
+        first = FeedItem.objects.get(pk=first.pk)
+        self.assertEqual(first.link_hash, digest(first.link))
+        self.assertEqual(first.guid, first.calculate_guid())
+        self.assertTrue(-2 ** 63 <= first.guid < 2 ** 63)
+
+        # Make the second item's link collide with the first's.
+        FeedItem.objects.filter(pk=second.pk).update(
+            link_hash=digest(first.link))
+        tmp = self._tmp(feed, 0, title=u'Post 0, revised')
+        item, created = FeedItem.bulk_get_or_create(feed, [tmp])[0]
+        self.assertFalse(created)
+        self.assertEqual(item.pk, first.pk)
+        tmp = self._tmp(feed, 0, title=u'Post 0, revised again')
+        self.assertEqual(FeedItem._get_or_create(tmp).pk, first.pk)
+        self.assertEqual(
+            FeedItem.objects.get(pk=second.pk).title, u'Post 1')
+
+    def test_bulk_get_or_create_duplicates(self):
+        '''Duplicate entries within one fetch resolve to one item.'''
+        feed = Feed()
+        feed.title = 'BoingBoing'
+        feed.link = 'http://boingboing.net'
+        feed.save()
+
+        tmps = [self._tmp(feed, 0), self._tmp(feed, 0)]
+        results = FeedItem.bulk_get_or_create(feed, tmps)
+        self.assertEqual(feed.items.count(), 1)
+        self.assertTrue(results[0][0] is results[1][0])
+
+    def test_bulk_get_or_create_race(self):
+        '''Items someone else inserted since we looked are matched, not
+        inserted again.'''
+        feed = Feed()
+        feed.title = 'BoingBoing'
+        feed.link = 'http://boingboing.net'
+        feed.save()
+
+        bulk_insert = FeedItem._bulk_insert
+
+        def racing(db, feed, new):
+            tmp = self._tmp(feed, 1)
+            FeedItem.objects.create(
+                feed=feed, guid=tmp.guid, title=tmp.title, link=tmp.link,
+                published=tmp.published)
+            return bulk_insert(db, feed, new)
+
+        tmps = [self._tmp(feed, i) for i in xrange(0, 3)]
+        with mock.patch.object(FeedItem, '_bulk_insert', side_effect=racing):
+            results = FeedItem.bulk_get_or_create(feed, tmps)
+        self.assertEqual([created for item, created in results],
+                         [True, False, True])
+        self.assertEqual(feed.items.count(), 3)
+        self.assertEqual(
+            set(item.pk for item, created in results),
+            set(feed.items.values_list('pk', flat=True)))
+        self.assertEqual(
+            FeedItemContent.objects.get(item=results[0][0]).description,
+            u'Words.')
+
+    def test_duplicate_unread(self):
+        '''Deleting a duplicate item keeps unread counts right.'''
+        user = User.objects.create_user('bob', 'bob@example.com')
+        feed = Feed()
+        feed.title = 'BoingBoing'
+        feed.link = 'http://boingboing.net'
+        feed.save()
+        feed.add_subscriber(user)
+        for title in (u'Post 0', u'Post 0, again'):
+            item = self._tmp(feed, 0, title=title)
+            item.save()
+        self.assertEqual(UserFeed.objects.get(user=user).unread, 2)
+
+        FeedItem.bulk_get_or_create(feed, [self._tmp(feed, 0)])
+        self.assertEqual(feed.items.count(), 1)
+        self.assertEqual(UserFeed.objects.get(user=user).unread, 1)
+
     @unittest.skipUnless(network_available(), 'Network unavailable')
     @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
                        CELERY_ALWAYS_EAGER=True,
@@ -421,6 +850,103 @@ class FeedItemTest(TestCase):
 class UserFeedItemTest(TestCase):
     '''Test the UserFeedItem model.'''
 
+    def test_published(self):
+        '''UserFeedItem keeps a copy of its item's published date.'''
+        bob = User.objects.create(email='Bob')
+        steve = User.objects.create(email='Steve')
+        feed = Feed.objects.create(
+            title='BoingBoing', link='http://boingboing.net')
+        old = datetime(2013, 6, 1)
+        item = FeedItem(
+            feed=feed, title='Old', description='', published=old,
+            link='http://boingboing.net/old',
+            guid='http://boingboing.net/old')
+        item.save()
+
+        # Subscribing, fanning out, and a plain save all fill it in.
+        feed.add_subscriber(bob)
+        new = FeedItem(
+            feed=feed, title='New', description='',
+            published=datetime(2013, 7, 1), link='http://boingboing.net/new',
+            guid='http://boingboing.net/new')
+        new.save()
+        UserFeedItem.objects.create(user=steve, feed=feed, item=item)
+
+        self.assertEqual(
+            sorted(UserFeedItem.objects.values_list('published', flat=True)),
+            [old, old, datetime(2013, 7, 1)])
+
+        # And it follows edits to the item, which syncing clients hear
+        # about too.
+        item.published = datetime(2013, 8, 1)
+        item.save()
+        self.assertEqual(
+            UserFeedItem.objects.filter(
+                published=datetime(2013, 8, 1)).count(), 2)
+
+        item.title = 'Old, but retitled'
+        item.save()
+        for user in (bob, steve):
+            self.assertEqual(
+                UserFeedItem.objects.get(user=user, item=item).seq,
+                UserSequence.current(user))
+
+    def test_add_to_users(self):
+        '''Fan out is a fixed number of queries, however many subscribers.'''
+        feed = Feed()
+        feed.title = 'BoingBoing'
+        feed.link = 'http://boingboing.net'
+        feed.save()
+        users = []
+        for i in xrange(0, 20):
+            user = User.objects.create_user(
+                'user{0}'.format(i), 'user{0}@example.com'.format(i))
+            UserFeed.objects.create(user=user, feed=feed)
+            users.append(user)
+
+        items = []
+        for i, published in enumerate([datetime(2013, 1, 1),
+                                       datetime(2013, 6, 1),
+                                       datetime(2013, 6, 2)]):
+            tmp = FeedItem()
+            tmp.feed = feed
+            tmp.title = u'Post {0}'.format(i)
+            tmp.link = u'http://www.example.com/post/{0}'.format(i)
+            tmp.update_link_hash()
+            tmp.atom_id = u''
+            tmp.description = u'Words.'
+            tmp.published = published
+            tmp.guid = tmp.calculate_guid()
+            items.append(tmp)
+        items = [item for item, created in
+                 FeedItem.bulk_get_or_create(feed, items)]
+
+        # Someone already has one of them, and has starred it.
+        UserFeedItem.objects.create(
+            user=users[0], feed=feed, item=items[2], starred=True)
+
+        # The subscribers, the INSERT, a count of what it added, one
+        # counter UPDATE for everyone getting two unread items and one for
+        # users[0], who already had one of them, and two to advance
+        # everyone's UserSequence.
+        with self.assertNumQueries(7):
+            UserFeedItem.add_to_users(feed, items)
+
+        self.assertEqual(UserFeedItem.objects.filter(feed=feed).count(), 60)
+        # Old items come in read.
+        self.assertEqual(
+            UserFeedItem.objects.filter(feed=feed, read=False).count(), 40)
+        self.assertEqual(
+            UserFeed.objects.get(user=users[0], feed=feed).unread, 2)
+        self.assertEqual(
+            UserFeed.objects.get(user=users[1], feed=feed).unread, 2)
+        self.assertTrue(UserFeedItem.objects.get(
+            user=users[0], item=items[2]).starred)
+
+        # Doing it again is harmless.
+        UserFeedItem.add_to_users(feed, items, mark_as_read=True)
+        self.assertEqual(UserFeedItem.objects.filter(feed=feed).count(), 60)
+
     def test_basics(self):
         user = User()
         user.email = 'Bob'
@@ -444,6 +970,12 @@ class UserFeedItemTest(TestCase):
         # subscribed users seeing all those new items.
         self.assertEqual(user.feeditems.count(), 1)
 
+        # ...but only when it's new. Edits don't hand it out again.
+        UserFeedItem.objects.filter(user=user).delete()
+        item.title = 'Octopus v. Platypus, the rematch'
+        item.save()
+        self.assertEqual(user.feeditems.count(), 0)
+
     def test_tagging(self):
         user = User()
         user.email = 'Bob'
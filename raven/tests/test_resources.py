@@ -4,10 +4,13 @@ import json
 import unittest
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
 from tastypie.test import ResourceTestCase
 
+from raven import resources, viewcache
 from raven.models import Feed, FeedItem, UserFeed, UserFeedItem
 from raven.test_utils import network_available
 
@@ -15,7 +18,7 @@ User = get_user_model()
 
 __all__ = [
     'API095Test', 'UserFeedResourceTest', 'UserFeedItemResourceTest',
-    'FeedResource09Test', 'FeedItemResource09Test',
+    'SyncResourceTest', 'BootstrapTest', 'FeedResource09Test', 'FeedItemResource09Test',
     ]
 
 
@@ -31,6 +34,10 @@ class API095TestCase(ResourceTestCase):
 
         self.api_client.client.login(username='bob@example.com', password='bob')
 
+        # Cached pages are keyed by user and version, both of which start
+        # over with each test.
+        cache.clear()
+
 
 class API095Test(API095TestCase):
     '''Test the 0.9.5 api endpoints.'''
@@ -41,7 +48,7 @@ class API095Test(API095TestCase):
         self.assertEqual(200, result.status_code)
 
         content = json.loads(result.content)
-        self.assertEqual(content.keys(), ['feed', 'item'])
+        self.assertEqual(sorted(content.keys()), ['feed', 'item', 'sync'])
         self.assertEqual(content['feed'].keys(), ['list_endpoint', 'schema'])
         self.assertEqual(content['feed']['list_endpoint'], '/api/0.9.5/feed/')
 
@@ -101,7 +108,8 @@ class UserFeedResourceTest(API095TestCase):
         content = json.loads(result.content)
         self.assertEqual(
             sorted(content.keys()),
-            ['description', 'id', 'link', 'resource_uri', 'tags', 'title'])
+            ['description', 'id', 'link', 'resource_uri', 'tags', 'title',
+             'unread'])
         self.assertEqual(content['description'], feed.description)
         self.assertEqual(content['link'], feed.link)
         self.assertEqual(content['title'], feed.title)
@@ -217,11 +225,10 @@ class UserFeedItemResourceTest(API095TestCase):
         content = json.loads(result.content)
         self.assertEqual(content.keys(), ['meta', 'objects'])
         self.assertEqual(
-            content['meta'].keys(),
-            ['previous', 'total_count', 'offset', 'limit', 'next'])
+            sorted(content['meta'].keys()),
+            ['limit', 'next', 'previous', 'total_count'])
         self.assertEqual(content['meta']['previous'], None)
         self.assertEqual(content['meta']['total_count'], 0)
-        self.assertEqual(content['meta']['offset'], 0)
         self.assertEqual(content['meta']['limit'], 20)
         self.assertEqual(content['meta']['next'], None)
         self.assertEqual(content['objects'], [])
@@ -246,11 +253,10 @@ class UserFeedItemResourceTest(API095TestCase):
         content = json.loads(result.content)
         self.assertEqual(content.keys(), ['meta', 'objects'])
         self.assertEqual(
-            content['meta'].keys(),
-            ['previous', 'total_count', 'offset', 'limit', 'next'])
+            sorted(content['meta'].keys()),
+            ['limit', 'next', 'previous', 'total_count'])
         self.assertEqual(content['meta']['previous'], None)
         self.assertEqual(content['meta']['total_count'], 1)
-        self.assertEqual(content['meta']['offset'], 0)
         self.assertEqual(content['meta']['limit'], 20)
         self.assertEqual(content['meta']['next'], None)
 
@@ -277,9 +283,9 @@ class UserFeedItemResourceTest(API095TestCase):
         content = json.loads(result.content)
         self.assertEqual(
             sorted(content.keys()),
-            ['description', 'feed', 'feed_id', 'feed_tags', 'feed_title',
-             'id', 'link', 'published', 'read', 'resource_uri', 'starred',
-             'tags', 'title'])
+            ['description', 'excerpt', 'feed', 'feed_id', 'feed_tags',
+             'feed_title', 'id', 'link', 'published', 'read', 'resource_uri',
+             'starred', 'tags', 'title', 'word_count'])
         self.assertEqual(content['description'], item.description)
         self.assertEqual(content['link'], item.link)
         self.assertEqual(
@@ -669,11 +675,10 @@ class UserFeedItemResourceTest(API095TestCase):
         content = json.loads(result.content)
         self.assertEqual(content.keys(), ['meta', 'objects'])
         self.assertEqual(
-            content['meta'].keys(),
-            ['previous', 'total_count', 'offset', 'limit', 'next'])
+            sorted(content['meta'].keys()),
+            ['limit', 'next', 'previous', 'total_count'])
         self.assertEqual(content['meta']['previous'], None)
         self.assertEqual(content['meta']['total_count'], 1)
-        self.assertEqual(content['meta']['offset'], 0)
         self.assertEqual(content['meta']['limit'], 20)
         self.assertEqual(content['meta']['next'], None)
 
@@ -698,16 +703,244 @@ class UserFeedItemResourceTest(API095TestCase):
         content = json.loads(result.content)
         self.assertEqual(content.keys(), ['meta', 'objects'])
         self.assertEqual(
-            content['meta'].keys(),
-            ['previous', 'total_count', 'offset', 'limit', 'next'])
+            sorted(content['meta'].keys()),
+            ['limit', 'next', 'previous', 'total_count'])
         self.assertEqual(content['meta']['previous'], None)
         self.assertEqual(content['meta']['total_count'], 50)
-        self.assertEqual(content['meta']['offset'], 0)
         self.assertEqual(content['meta']['limit'], 20)
+        self.assertIn('cursor=', content['meta']['next'])
+        self.assertEqual(len(content['objects']), 20)
+        titles = [obj['title'] for obj in content['objects']]
+
+        # Follow the cursors to the end, and back again. Later pages
+        # aren't counted.
+        result = self.api_client.get(content['meta']['next'])
+        content = json.loads(result.content)
+        self.assertEqual(len(content['objects']), 20)
+        self.assertNotIn('total_count', content['meta'])
+        titles.extend(obj['title'] for obj in content['objects'])
+        second_page = content['objects']
+
+        result = self.api_client.get(content['meta']['next'])
+        content = json.loads(result.content)
+        self.assertEqual(len(content['objects']), 10)
+        self.assertEqual(content['meta']['next'], None)
+        titles.extend(obj['title'] for obj in content['objects'])
         self.assertEqual(
-            content['meta']['next'].split('?')[1],
-            'limit=20&offset=20')
+            sorted(titles),
+            sorted('Feed title {0}'.format(i) for i in xrange(0, 50)))
+
+        result = self.api_client.get(content['meta']['previous'])
+        content = json.loads(result.content)
+        self.assertEqual(content['objects'], second_page)
+
+    def test_endpoint_bad_cursor(self):
+        result = self.api_client.get('/api/0.9.5/item/?cursor=bogus')
+        self.assertEqual(400, result.status_code)
+
+    def test_endpoint_query_count(self):
+        '''A page costs the same number of queries whatever its size.'''
+        for i in xrange(0, 2):
+            feed = Feed.create_and_subscribe(
+                'Paul Hummer', 'http://www.paulhummer.org/rss{0}'.format(i),
+                None, self.user)
+            UserFeed.objects.get(user=self.user, feed=feed).tags.add('nerd')
+            for j in xrange(0, 10):
+                item = FeedItem()
+                item.feed = feed
+                item.title = 'Feed title {0}'.format(j)
+                item.link = 'http://www.paulhummer.org/rss{0}/{1}'.format(i, j)
+                item.guid = item.link
+                item.published = datetime.now()
+                item.save()
+                UserFeedItem.objects.get(
+                    user=self.user, item=item).tags.add('later')
+
+        # Session, user, version, count, page, UserFeeds and the two sets
+        # of tags.
+        with self.assertNumQueries(8):
+            result = self.api_client.get('/api/0.9.5/item/?limit=2')
+        self.assertEqual(len(json.loads(result.content)['objects']), 2)
+
+        with self.assertNumQueries(8):
+            result = self.api_client.get('/api/0.9.5/item/?limit=20')
+        content = json.loads(result.content)
         self.assertEqual(len(content['objects']), 20)
+        for obj in content['objects']:
+            self.assertEqual(obj['feed_tags'], ['nerd'])
+            self.assertEqual(obj['tags'], ['later'])
+
+    def test_endpoint_cached(self):
+        '''A page is served from the cache until the user changes
+        something.'''
+        feed = Feed.create_and_subscribe(
+            'Paul Hummer', 'http://www.paulhummer.org/rss', None, self.user)
+        for i in xrange(0, 3):
+            item = FeedItem()
+            item.feed = feed
+            item.title = 'Feed title {0}'.format(i)
+            item.link = 'http://www.paulhummer.org/rss/{0}'.format(i)
+            item.guid = item.link
+            item.published = datetime.now()
+            item.save()
+
+        result = self.api_client.get('/api/0.9.5/item/?read=false')
+        self.assertEqual(len(json.loads(result.content)['objects']), 3)
+
+        # Session, user and version.
+        with self.assertNumQueries(3):
+            cached = self.api_client.get('/api/0.9.5/item/?read=false')
+        self.assertEqual(cached.content, result.content)
+        self.assertEqual(viewcache.stats(), {'hits': 1, 'misses': 1})
+
+        useritem = UserFeedItem.objects.filter(user=self.user)[0]
+        useritem.read = True
+        useritem.save()
+        result = self.api_client.get('/api/0.9.5/item/?read=false')
+        self.assertEqual(len(json.loads(result.content)['objects']), 2)
+        self.assertEqual(viewcache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_endpoint_not_modified(self):
+        '''A poll with a current ETag gets a 304, without the list query.'''
+        feed = Feed.create_and_subscribe(
+            'Paul Hummer', 'http://www.paulhummer.org/rss', None, self.user)
+        item = FeedItem()
+        item.feed = feed
+        item.title = 'Feed title'
+        item.link = 'http://www.paulhummer.org/rss/1'
+        item.guid = item.link
+        item.published = datetime.now()
+        item.save()
+
+        result = self.api_client.get('/api/0.9.5/item/')
+        self.assertEqual(result.status_code, 200)
+        etag = result['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+
+        # Session, user and version.
+        with self.assertNumQueries(3):
+            result = self.api_client.get(
+                '/api/0.9.5/item/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.content, '')
+        self.assertEqual(result['ETag'], etag)
+
+        # Another page is another tag.
+        result = self.api_client.get(
+            '/api/0.9.5/item/?read=false', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result['ETag'], etag)
+
+        useritem = UserFeedItem.objects.get(user=self.user, item=item)
+        useritem.read = True
+        useritem.save()
+        result = self.api_client.get(
+            '/api/0.9.5/item/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result['ETag'], etag)
+        self.assertEqual(json.loads(result.content)['objects'][0]['read'], True)
+
+        # With the view cache off, nothing can be trusted to stay current.
+        with self.settings(RAVEN_VIEW_CACHE_TIMEOUT=0):
+            result = self.api_client.get(
+                '/api/0.9.5/item/', HTTP_IF_NONE_MATCH=result['ETag'])
+        self.assertEqual(result.status_code, 200)
+        self.assertFalse(result.has_header('ETag'))
+
+    def test_endpoint_fields(self):
+        '''fields= trims the response, and the queries behind it.'''
+        feed = Feed.create_and_subscribe(
+            'Paul Hummer', 'http://www.paulhummer.org/rss', None, self.user)
+        for i in xrange(0, 3):
+            item = FeedItem()
+            item.feed = feed
+            item.title = 'Feed title {0}'.format(i)
+            item.link = 'http://www.paulhummer.org/rss/{0}'.format(i)
+            item.guid = item.link
+            item.description = 'Lots of words.'
+            item.published = datetime.now()
+            item.save()
+
+        # Session, user, version, count and page; no UserFeeds or tags.
+        with self.assertNumQueries(5):
+            result = self.api_client.get(
+                '/api/0.9.5/item/', data={'fields': 'title,read'})
+        content = json.loads(result.content)
+        self.assertEqual(len(content['objects']), 3)
+        for obj in content['objects']:
+            self.assertEqual(
+                sorted(obj.keys()), ['id', 'read', 'resource_uri', 'title'])
+
+        result = self.api_client.get(
+            '/api/0.9.5/item/', data={'fields': 'excerpt,word_count'})
+        obj = json.loads(result.content)['objects'][0]
+        self.assertEqual(obj['excerpt'], 'Lots of words.')
+        self.assertEqual(obj['word_count'], 3)
+        self.assertNotIn('description', obj)
+
+        result = self.api_client.get(
+            '/api/0.9.5/item/', data={'fields': 'description,tags'})
+        obj = json.loads(result.content)['objects'][0]
+        self.assertEqual(obj['description'], 'Lots of words.')
+        self.assertEqual(obj['tags'], [])
+
+        result = self.api_client.get(
+            '/api/0.9.5/feed/', data={'fields': 'title'})
+        obj = json.loads(result.content)['objects'][0]
+        self.assertEqual(sorted(obj.keys()), ['id', 'resource_uri', 'title'])
+
+    def test_search(self):
+        '''Search the user's items, narrowed down by feed, tag, read and
+        starred.'''
+        userfeeds = []
+        for i, word in enumerate(['bunny', 'kitten']):
+            feed = Feed.create_and_subscribe(
+                'Paul Hummer', 'http://www.paulhummer.org/rss{0}'.format(i),
+                None, self.user)
+            for j in xrange(0, 3):
+                item = FeedItem()
+                item.feed = feed
+                item.title = 'Cute {0} {1}'.format(word, j)
+                item.link = 'http://www.paulhummer.org/rss{0}/{1}'.format(i, j)
+                item.guid = item.link
+                item.description = '<p>Fluffy {0}.</p>'.format(j)
+                item.published = datetime(2013, 7, 1 + j, i)
+                item.save()
+            userfeeds.append(
+                UserFeed.objects.get(user=self.user, feed=feed))
+        userfeeds[1].tags.add('cats')
+        UserFeedItem.objects.filter(
+            user=self.user, item__title='Cute bunny 2').update(read=True)
+        endpoint = '/api/0.9.5/item/search/'
+
+        def titles(**data):
+            result = self.api_client.get(endpoint, data=data)
+            self.assertEqual(result.status_code, 200)
+            return [obj['title'] for obj in
+                    json.loads(result.content)['objects']]
+
+        self.assertEqual(
+            titles(q='bunny'),
+            ['Cute bunny 2', 'Cute bunny 1', 'Cute bunny 0'])
+        self.assertEqual(titles(q='fluffy 1'), ['Cute kitten 1', 'Cute bunny 1'])
+        self.assertEqual(
+            titles(q='cute', feed=userfeeds[0].pk, read='false'),
+            ['Cute bunny 1', 'Cute bunny 0'])
+        self.assertEqual(len(titles(q='cute', tag='cats')), 3)
+        self.assertEqual(titles(q='cute', limit=1, offset=1), ['Cute bunny 2'])
+        self.assertEqual(titles(q='puppy'), [])
+
+        # An item with more than one of the tags still comes back once.
+        item = UserFeedItem.objects.get(
+            user=self.user, item__title='Cute kitten 0')
+        item.tags.add('later', 'best')
+        self.assertEqual(
+            titles(q='cute', tags='later,best'), ['Cute kitten 0'])
+
+        result = self.api_client.get(endpoint)
+        self.assertEqual(result.status_code, 400)
+        result = self.api_client.get(endpoint, data={'q': 'cute', 'feed': 'x'})
+        self.assertEqual(result.status_code, 400)
 
     def test_put_read(self):
         '''We can set 'read' via the API.'''
@@ -734,6 +967,47 @@ class UserFeedItemResourceTest(API095TestCase):
         new_resource = json.loads(self.api_client.get(endpoint).content)
         self.assertEqual(new_resource['read'], True)
 
+    def test_mark_read(self):
+        '''Mark whole swathes of items read in one go.'''
+        feeds = []
+        for i in xrange(0, 3):
+            feed = Feed.create_and_subscribe(
+                'Paul Hummer', 'http://www.paulhummer.org/rss{0}'.format(i),
+                None, self.user)
+            for j in xrange(0, 5):
+                item = FeedItem()
+                item.feed = feed
+                item.title = 'Feed title {0}'.format(j)
+                item.link = 'http://www.paulhummer.org/rss{0}/{1}'.format(i, j)
+                item.guid = item.link
+                item.published = datetime(2013, 7, 1 + j)
+                item.save()
+            feeds.append(UserFeed.objects.get(user=self.user, feed=feed))
+        feeds[1].tags.add('nerd')
+        endpoint = '/api/0.9.5/item/mark_read/'
+
+        result = self.api_client.post(
+            endpoint, format='json', data={'feed': feeds[0].pk})
+        self.assertEqual(result.status_code, 200)
+        content = json.loads(result.content)
+        self.assertEqual(content['count'], 5)
+        self.assertEqual(content['feeds'], {str(feeds[0].pk): 5})
+        self.assertEqual(UserFeed.objects.get(pk=feeds[0].pk).unread, 0)
+
+        result = self.api_client.post(
+            endpoint, format='json',
+            data={'tag': 'nerd', 'before': '2013-07-03T00:00:00Z'})
+        self.assertEqual(json.loads(result.content)['count'], 2)
+        self.assertEqual(UserFeed.objects.get(pk=feeds[1].pk).unread, 3)
+
+        result = self.api_client.post(endpoint, format='json', data={'all': True})
+        self.assertEqual(json.loads(result.content)['count'], 8)
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=self.user, read=False).count(), 0)
+
+        result = self.api_client.post(endpoint, format='json', data={})
+        self.assertEqual(result.status_code, 400)
+
     def test_put_starred(self):
         '''We can set 'starred' via the API.'''
         # Test data
@@ -759,6 +1033,78 @@ class UserFeedItemResourceTest(API095TestCase):
         new_resource = json.loads(self.api_client.get(endpoint).content)
         self.assertEqual(new_resource['starred'], True)
 
+    @override_settings(RAVEN_WRITE_BEHIND=True)
+    def test_put_write_behind(self):
+        '''With write-behind on, PUTs are buffered until the next read.'''
+        cache.clear()
+        feed = Feed.create_and_subscribe(
+            'Paul Hummer', 'http://www.paulhummer.org/rss', None, self.user)
+        for i in xrange(0, 3):
+            item = FeedItem()
+            item.feed = feed
+            item.title = 'Feed title {0}'.format(i)
+            item.link = 'http://www.paulhummer.org/rss/{0}'.format(i)
+            item.guid = item.link
+            item.published = datetime.now()
+            item.save()
+
+        content = json.loads(self.api_client.get('/api/0.9.5/item/').content)
+        for resource in content['objects']:
+            resource['read'] = True
+            result = self.api_client.put(
+                resource['resource_uri'], format='json', data=resource)
+            self.assertEqual(result.status_code, 204)
+        for resource in content['objects'][:2]:
+            resource['starred'] = True
+            self.api_client.put(
+                resource['resource_uri'], format='json', data=resource)
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=self.user, read=True).count(), 0)
+
+        # Reading flushes them out first.
+        content = json.loads(
+            self.api_client.get('/api/0.9.5/item/?read=false').content)
+        self.assertEqual(content['objects'], [])
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=self.user, starred=True).count(),
+            2)
+        self.assertEqual(
+            UserFeed.objects.get(user=self.user, feed=feed).unread, 0)
+
+    @override_settings(RAVEN_WRITE_BEHIND=True)
+    def test_put_write_behind_other_fields(self):
+        '''A PUT that changes more than read and starred is saved
+        straight away, on top of anything already buffered.'''
+        cache.clear()
+        feed = Feed.create_and_subscribe(
+            'Paul Hummer', 'http://www.paulhummer.org/rss', None, self.user)
+        for i in xrange(0, 2):
+            item = FeedItem()
+            item.feed = feed
+            item.title = 'Feed title {0}'.format(i)
+            item.link = 'http://www.paulhummer.org/rss/{0}'.format(i)
+            item.guid = item.link
+            item.published = datetime.now()
+            item.save()
+
+        content = json.loads(self.api_client.get('/api/0.9.5/item/').content)
+        first, second = content['objects']
+        first['read'] = True
+        self.api_client.put(first['resource_uri'], format='json', data=first)
+        second['read'] = True
+        second['published'] = '2013-01-01T00:00:00'
+        result = self.api_client.put(
+            second['resource_uri'], format='json', data=second)
+        self.assertEqual(result.status_code, 204)
+
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=self.user, read=True).count(), 2)
+        self.assertEqual(
+            UserFeedItem.objects.get(pk=second['id']).published,
+            datetime(2013, 1, 1))
+        self.assertEqual(
+            UserFeed.objects.get(user=self.user, feed=feed).unread, 0)
+
     def test_sort_published(self):
         '''We can sort by 'published'.'''
         # Test data
@@ -806,6 +1152,159 @@ class UserFeedItemResourceTest(API095TestCase):
             ['Feed 1', 'Feed 2', 'Feed 3'])
 
 
+class SyncResourceTest(API095TestCase):
+    '''Test SyncResource.'''
+
+    def sync(self, token=None):
+        data = {} if token is None else {'token': token}
+        result = self.api_client.get('/api/0.9.5/sync/', data=data)
+        self.assertEqual(result.status_code, 200)
+        return json.loads(result.content)
+
+    def add_feed(self, i):
+        feed = Feed.create_and_subscribe(
+            'Paul Hummer', 'http://www.paulhummer.org/rss{0}'.format(i),
+            None, self.user)
+        for j in xrange(0, 3):
+            item = FeedItem()
+            item.feed = feed
+            item.title = 'Feed title {0}'.format(j)
+            item.link = 'http://www.paulhummer.org/rss{0}/{1}'.format(i, j)
+            item.guid = item.link
+            item.published = datetime.utcnow()
+            item.save()
+        return UserFeed.objects.get(user=self.user, feed=feed)
+
+    def test_sync(self):
+        '''Only what changed since the token comes back.'''
+        userfeed = self.add_feed(0)
+        content = self.sync()
+        self.assertEqual(content['items'], [])
+        token = content['token']
+
+        # Nothing's changed.
+        content = self.sync(token)
+        self.assertEqual(content['items'], [])
+        self.assertEqual(content['feeds'], [])
+        self.assertEqual(content['token'], token)
+        self.assertEqual(content['unread'], {str(userfeed.pk): 3})
+
+        item = UserFeedItem.objects.filter(user=self.user)[0]
+        item.read = True
+        item.save()
+        other = UserFeedItem.objects.filter(user=self.user).exclude(
+            pk=item.pk)[0]
+        other.tags.add('later')
+        content = self.sync(token)
+        self.assertEqual(
+            sorted(obj['id'] for obj in content['items']),
+            sorted([item.pk, other.pk]))
+        changed = dict((obj['id'], obj) for obj in content['items'])
+        self.assertTrue(changed[item.pk]['read'])
+        self.assertEqual(changed[other.pk]['tags'], ['later'])
+        self.assertEqual(content['unread'], {str(userfeed.pk): 2})
+        token = content['token']
+
+        # A new subscription brings its feed and items; dropping one
+        # leaves its id.
+        new_userfeed = self.add_feed(1)
+        userfeed.feed.remove_subscriber(self.user)
+        content = self.sync(token)
+        self.assertEqual(len(content['items']), 3)
+        self.assertEqual(
+            [obj['id'] for obj in content['feeds']], [new_userfeed.pk])
+        self.assertEqual(content['removed_feeds'], [userfeed.pk])
+        self.assertEqual(content['unread'], {str(new_userfeed.pk): 3})
+
+        self.assertEqual(self.sync(content['token'])['items'], [])
+
+    def test_sync_paging(self):
+        '''Big changes come in pages, none of them missed.'''
+        token = self.sync()['token']
+        for i in xrange(0, 4):
+            self.add_feed(i)
+
+        seen = []
+        resources.SyncResource._meta.max_limit = 5
+        try:
+            content = self.sync(token)
+            seen.extend(obj['id'] for obj in content['items'])
+            while content['more']:
+                self.assertEqual(len(content['items']), 5)
+                content = self.sync(content['token'])
+                seen.extend(obj['id'] for obj in content['items'])
+        finally:
+            resources.SyncResource._meta.max_limit = 100
+        self.assertEqual(
+            sorted(seen), sorted(UserFeedItem.objects.filter(
+                user=self.user).values_list('pk', flat=True)))
+
+    def test_bad_token(self):
+        '''A token that isn't one is a 400.'''
+        result = self.api_client.get(
+            '/api/0.9.5/sync/', data={'token': 'not a token'})
+        self.assertEqual(result.status_code, 400)
+
+
+class BootstrapTest(API095TestCase):
+    '''Test the reader's bootstrap data.'''
+
+    def setUp(self):
+        super(BootstrapTest, self).setUp()
+        for i in xrange(0, 2):
+            feed = Feed.create_and_subscribe(
+                'Paul Hummer', 'http://www.paulhummer.org/rss{0}'.format(i),
+                None, self.user)
+            for j in xrange(0, 3):
+                item = FeedItem()
+                item.feed = feed
+                item.title = u'Feed <title> & \u2028 {0}'.format(j)
+                item.link = 'http://www.paulhummer.org/rss{0}/{1}'.format(
+                    i, j)
+                item.guid = item.link
+                item.published = datetime.utcnow() - timedelta(hours=j)
+                item.save()
+        self.userfeed = UserFeed.objects.get(
+            user=self.user, feed__link='http://www.paulhummer.org/rss0')
+        self.userfeed.tags.add('blog')
+
+    def test_bootstrap(self):
+        '''Feeds, tags, unread counts and the first page, in one go.'''
+        with self.assertNumQueries(10):
+            result = self.api_client.client.get('/reader/bootstrap/')
+        self.assertEqual(result.status_code, 200)
+        for char in ('<', '>', '&', u'\u2028'.encode('utf-8')):
+            self.assertNotIn(char, result.content)
+        content = json.loads(result.content)
+
+        self.assertEqual(
+            sorted(content.keys()),
+            ['feeds', 'items', 'tags', 'unread', 'untagged_unread'])
+        self.assertEqual(content['unread'], 6)
+        self.assertEqual(content['untagged_unread'], 3)
+        self.assertEqual(content['tags'], [
+            {'name': 'blog', 'unread': 3, 'feeds': [self.userfeed.pk]}])
+        feeds = dict((feed['id'], feed) for feed in content['feeds'])
+        self.assertEqual(feeds[self.userfeed.pk]['tags'], ['blog'])
+        self.assertEqual(feeds[self.userfeed.pk]['unread'], 3)
+
+        items = content['items']['objects']
+        self.assertEqual(len(items), 6)
+        self.assertEqual(items[0]['title'], u'Feed <title> & \u2028 0')
+        self.assertTrue(items[0]['resource_uri'].startswith(
+            '/api/0.9.5/item/'))
+        self.assertEqual(
+            [item['published'] for item in items],
+            sorted([item['published'] for item in items], reverse=True))
+
+    def test_reader(self):
+        '''The reader page comes with the bootstrap data in it.'''
+        result = self.api_client.client.get('/reader/')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('window.BOOTSTRAP = {', result.content)
+        self.assertIn('href="#tag/blog"', result.content)
+
+
 class FeedResource09Test(ResourceTestCase):
     '''Test the FeedResource.'''
 
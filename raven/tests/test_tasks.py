@@ -3,11 +3,14 @@ import os
 import unittest
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.utils import override_settings
+import feedparser
+import mock
 
-from raven import tasks
-from raven.models import Feed, UserFeedItem
+from raven import tasks, writebehind
+from raven.models import Feed, FeedItem, UserFeed, UserFeedItem
 from raven.test_utils import network_available
 
 THIS_DIR = os.path.dirname(__file__)
@@ -17,7 +20,9 @@ SECURE_FILE = os.path.join(THIS_DIR, '..', '..', 'secure')
 User = get_user_model()
 
 __all__ = [
-    'UpdateFeedTaskTest', 'EatTakeoutTaskTest', 'SyncFromReaderAPITaskTest']
+    'UpdateFeedTaskTest', 'UpdateFeedsTest', 'UpdateFeedBeatTest',
+    'FlushReadStateBeatTest', 'NewUserItemsTest', 'EatTakeoutTaskTest',
+    'SyncFromReaderAPITaskTest']
 
 
 class UpdateFeedTaskTest(TestCase):
@@ -77,6 +82,288 @@ class UpdateFeedTaskTest(TestCase):
         self.assertEqual(feed.feeditems.count(), 15)
 
 
+class UpdateFeedsTest(TestCase):
+    '''Test the update_feeds task.'''
+
+    def _feeds(self, count):
+        last_fetched = datetime.utcnow() - timedelta(minutes=31)
+        for i in xrange(0, count):
+            feed = Feed()
+            feed.link = 'http://www.example.com/rss{0}'.format(i)
+            feed.last_fetched = last_fetched
+            feed.save()
+        return list(Feed.objects.all())
+
+    @override_settings(RAVEN_FETCH_CONCURRENCY=4, RAVEN_FETCH_TIMEOUT=5)
+    def test_concurrent(self):
+        feeds = self._feeds(10)
+        # Fetched recently, so it shouldn't go out to the network.
+        fresh = feeds[0]
+        fresh.last_fetched = datetime.utcnow()
+        fresh.save()
+
+        data = feedparser.FeedParserDict(status=304, bozo=0, entries=[])
+        with mock.patch.object(Feed, 'fetch', return_value=data) as fetch:
+            tasks.update_feeds(feeds)
+
+        self.assertEqual(fetch.call_count, 9)
+        fetch.assert_called_with(timeout=5)
+        for feed in Feed.objects.exclude(pk=fresh.pk):
+            self.assertTrue(
+                datetime.utcnow() - feed.last_fetched < timedelta(minutes=1))
+
+    @override_settings(RAVEN_FETCH_CONCURRENCY=1)
+    def test_serial(self):
+        feeds = self._feeds(3)
+
+        data = feedparser.FeedParserDict(status=304, bozo=0, entries=[])
+        with mock.patch.object(Feed, 'fetch', return_value=data) as fetch:
+            tasks.update_feeds(feeds)
+
+        self.assertEqual(fetch.call_count, 3)
+
+    def test_empty(self):
+        '''An empty batch is a no-op, not a crash.'''
+        tasks.update_feeds(Feed.objects.none())
+
+
+class UpdateFeedBeatTest(TestCase):
+    '''Test the UpdateFeedBeat scheduler.'''
+
+    @override_settings(RAVEN_FETCH_BATCH_SIZE=2, RAVEN_FETCH_BATCHES=2)
+    def test_run(self):
+        now = datetime.utcnow()
+        for i in xrange(0, 6):
+            feed = Feed()
+            feed.link = 'http://www.example.com/rss{0}'.format(i)
+            feed.last_fetched = now - timedelta(minutes=60 + i)
+            feed.save()
+        # Not due for a while yet.
+        feed = Feed()
+        feed.link = 'http://www.example.com/fresh'
+        feed.last_fetched = now
+        feed.save()
+        # Never going to be due.
+        feed = Feed()
+        feed.link = 'http://www.example.com/dead'
+        feed.fetch_frequency = Feed.FETCH_NEVER
+        feed.save()
+        self.assertEqual(feed.next_fetch_at, None)
+
+        with mock.patch.object(tasks.update_feeds, 'apply_async') as apply_async:
+            tasks.UpdateFeedBeat().run()
+
+        # Two batches of two, most overdue first.
+        self.assertEqual(apply_async.call_count, 2)
+        claimed = [feed.link for call in apply_async.call_args_list
+                   for feed in call[0][0][0]]
+        self.assertEqual(claimed, [
+            'http://www.example.com/rss5', 'http://www.example.com/rss4',
+            'http://www.example.com/rss3', 'http://www.example.com/rss2'])
+
+        # Claimed feeds aren't handed out again on the next tick.
+        with mock.patch.object(tasks.update_feeds, 'apply_async') as apply_async:
+            tasks.UpdateFeedBeat().run()
+        claimed = [feed.link for call in apply_async.call_args_list
+                   for feed in call[0][0][0]]
+        self.assertEqual(claimed, [
+            'http://www.example.com/rss1', 'http://www.example.com/rss0'])
+
+    def test_claim(self):
+        '''Of two overlapping ticks, only the first gets the feeds.'''
+        now = datetime.utcnow()
+        feed = Feed()
+        feed.link = 'http://www.example.com/rss'
+        feed.last_fetched = now - timedelta(minutes=60)
+        feed.save()
+
+        beat = tasks.UpdateFeedBeat()
+        due = list(Feed.objects.filter(next_fetch_at__lte=now))
+        self.assertEqual(beat.claim(due, now), due)
+        self.assertEqual(
+            beat.claim(due, now + timedelta(seconds=1)), [])
+
+    def test_reschedule(self):
+        '''Saving a fetched feed schedules its next fetch.'''
+        feed = Feed()
+        feed.link = 'http://www.example.com/rss'
+        feed.save()
+        self.assertTrue(feed.next_fetch_at <= datetime.utcnow())
+
+        feed.last_fetched = datetime.utcnow()
+        feed.fetch_frequency = Feed.FETCH_SLOW
+        feed.save()
+        self.assertEqual(
+            feed.next_fetch_at,
+            feed.last_fetched + timedelta(minutes=Feed.FETCH_SLOW))
+
+
+class FlushReadStateBeatTest(TestCase):
+    '''Test the FlushReadStateBeat write-behind flusher.'''
+
+    @override_settings(RAVEN_WRITE_BEHIND=True)
+    def test_run(self):
+        cache.clear()
+        user = User.objects.create_user('bob', 'bob@example.com')
+        feed = Feed.objects.create(link='http://www.example.com/rss')
+        feed.add_subscriber(user)
+        for i in xrange(0, 3):
+            item = FeedItem(
+                feed=feed, title='Post {0}'.format(i), description='',
+                link='http://www.example.com/{0}'.format(i),
+                guid='http://www.example.com/{0}'.format(i),
+                published=datetime.utcnow())
+            item.save()
+
+        for user_item in UserFeedItem.objects.filter(user=user):
+            user_item.read = True
+            self.assertTrue(writebehind.buffer(user_item))
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=user, read=True).count(), 0)
+
+        # One UPDATE per distinct field and value (just read=True here),
+        # however many items, a count of the items it changes, one UPDATE
+        # to adjust the unread counter and two to advance the user's
+        # UserSequence.
+        with self.assertNumQueries(5):
+            tasks.FlushReadStateBeat().run()
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=user, read=True).count(), 3)
+        self.assertEqual(UserFeed.objects.get(user=user).unread, 0)
+
+        # Nothing left to do next time round.
+        with self.assertNumQueries(0):
+            tasks.FlushReadStateBeat().run()
+
+    @override_settings(RAVEN_WRITE_BEHIND=True, RAVEN_WRITE_BEHIND_MAX=2)
+    def test_threshold(self):
+        '''A full buffer is written out straight away.'''
+        cache.clear()
+        user = User.objects.create_user('bob', 'bob@example.com')
+        feed = Feed.objects.create(link='http://www.example.com/rss')
+        feed.add_subscriber(user)
+        for i in xrange(0, 2):
+            item = FeedItem(
+                feed=feed, title='Post {0}'.format(i), description='',
+                link='http://www.example.com/{0}'.format(i),
+                guid='http://www.example.com/{0}'.format(i),
+                published=datetime.utcnow())
+            item.save()
+
+        user_items = list(UserFeedItem.objects.filter(user=user))
+        user_items[0].starred = True
+        writebehind.buffer(user_items[0])
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=user, starred=True).count(), 0)
+        user_items[1].starred = True
+        writebehind.buffer(user_items[1])
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=user, starred=True).count(), 2)
+
+
+    @override_settings(RAVEN_WRITE_BEHIND=True)
+    def test_merge(self):
+        '''Only changed fields are buffered, so a stale copy of an item
+        can't undo a change still waiting to be written.'''
+        cache.clear()
+        user = User.objects.create_user('bob', 'bob@example.com')
+        feed = Feed.objects.create(link='http://www.example.com/rss')
+        feed.add_subscriber(user)
+        item = FeedItem(
+            feed=feed, title='Post', description='',
+            link='http://www.example.com/0', guid='http://www.example.com/0',
+            published=datetime.utcnow())
+        item.save()
+
+        user_item = UserFeedItem.objects.get(user=user)
+        user_item.starred = True
+        self.assertTrue(writebehind.buffer(user_item))
+        user_item = UserFeedItem.objects.get(user=user)
+        user_item.read = True
+        self.assertTrue(writebehind.buffer(user_item))
+
+        # Someone else is busy with the buffer, so flushing waits for
+        # them to finish rather than reading around their changes.
+        lock = writebehind._key(user.pk) + ':lock'
+        cache.add(lock, 1)
+        release = lambda seconds: cache.delete(lock)
+        with mock.patch('time.sleep', side_effect=release):
+            self.assertEqual(writebehind.flush(user.pk), 1)
+        user_item = UserFeedItem.objects.get(user=user)
+        self.assertTrue(user_item.read)
+        self.assertTrue(user_item.starred)
+        self.assertEqual(UserFeed.objects.get(user=user).unread, 0)
+
+    @override_settings(RAVEN_WRITE_BEHIND=True)
+    def test_flush_twice(self):
+        '''Marking an item read twice only counts it once.'''
+        cache.clear()
+        user = User.objects.create_user('bob', 'bob@example.com')
+        feed = Feed.objects.create(link='http://www.example.com/rss')
+        feed.add_subscriber(user)
+        for i in xrange(0, 2):
+            item = FeedItem(
+                feed=feed, title='Post {0}'.format(i), description='',
+                link='http://www.example.com/{0}'.format(i),
+                guid='http://www.example.com/{0}'.format(i),
+                published=datetime.utcnow())
+            item.save()
+        self.assertEqual(UserFeed.objects.get(user=user).unread, 2)
+
+        user_item = UserFeedItem.objects.filter(user=user)[0]
+        stale = UserFeedItem.objects.get(pk=user_item.pk)
+        user_item.read = True
+        writebehind.buffer(user_item)
+        self.assertEqual(writebehind.flush(user.pk), 1)
+        self.assertEqual(UserFeed.objects.get(user=user).unread, 1)
+
+        stale.read = True
+        writebehind.buffer(stale)
+        self.assertEqual(writebehind.flush(user.pk), 1)
+        self.assertEqual(UserFeed.objects.get(user=user).unread, 1)
+
+
+class NewUserItemsTest(TestCase):
+    '''Test the Reader importers' item handling.'''
+
+    def _entry(self, i):
+        return tasks.FakeEntry({
+            'id': 'tag:google.com,2005:reader/item/{0}'.format(i),
+            'title': 'Post {0}'.format(i),
+            'url': 'http://www.example.com/{0}'.format(i),
+            'content': 'Words.',
+            'time': 1370044800 + i,
+        })
+
+    def test_batch(self):
+        '''Entries are created and handed out a feed at a time.'''
+        user = User.objects.create_user('bob', 'bob@example.com')
+        other = User.objects.create_user('steve', 'steve@example.com')
+        feed = Feed.objects.create(link='http://www.example.com/rss')
+        feed.add_subscriber(user)
+        feed.add_subscriber(other)
+        shared = Feed.objects.create(link='http://www.example.com/shared')
+
+        entries = [(feed, self._entry(i)) for i in xrange(0, 3)]
+        entries.append((shared, self._entry(3)))
+        entries[0][1].starred = True
+        with mock.patch('raven.models.UserFeedItem.add_to_users',
+                        wraps=UserFeedItem.add_to_users) as add_to_users:
+            user_items = tasks._new_user_items(user, entries)
+        # Once for each feed.
+        self.assertEqual(add_to_users.call_count, 2)
+        self.assertEqual([user_item.item.title for user_item in user_items],
+                         ['Post 0', 'Post 1', 'Post 2', 'Post 3'])
+        self.assertTrue(user_items[0].starred)
+        self.assertEqual(feed.items.count(), 3)
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=other).count(), 3)
+        # Not subscribed, but it's theirs all the same.
+        self.assertEqual(user_items[3].feed, shared)
+        self.assertEqual(
+            UserFeedItem.objects.filter(user=user).count(), 4)
+
+
 class EatTakeoutTaskTest(TestCase):
     '''Test EatTakeoutTask.'''
 
@@ -1,6 +1,4 @@
 from django.conf.urls import patterns, include, url
-from django.contrib.auth.decorators import login_required
-from django.views.generic import TemplateView
 from tastypie.api import Api
 
 from raven import resources
@@ -13,6 +11,7 @@ v09.register(resources.FeedItemResource09())
 v095 = Api(api_name='0.9.5')
 v095.register(resources.UserFeedResource())
 v095.register(resources.UserFeedItemResource())
+v095.register(resources.SyncResource())
 
 urlpatterns = patterns(
     '',
@@ -20,9 +19,9 @@ urlpatterns = patterns(
     url(r'api/', include(v095.urls)),
 
     url(r'^reader/leftside', 'raven.views.leftside', name='reader.leftside'),
-    url(r'^reader',
-        login_required(TemplateView.as_view(template_name='raven/reader.html')),
-        name='raven.reader'),
+    url(r'^reader/bootstrap', 'raven.views.bootstrap',
+        name='reader.bootstrap'),
+    url(r'^reader', 'raven.views.reader', name='raven.reader'),
 
     url(r'^home', 'raven.views.home'),
     url(r'^values', 'raven.views.values'),
@@ -0,0 +1,104 @@
+'''A per-user cache for rendered fragments and API pages.
+
+Everything cached for a user is keyed by their UserSequence, which every
+change to what they see advances: subscribing, unsubscribing, tagging,
+reading, starring, new items arriving and edits to their feeds and
+items. So a page is never served once something on it has changed; its
+key just stops being asked for, and it expires after
+RAVEN_VIEW_CACHE_TIMEOUT seconds.
+
+Entries go in the RAVEN_VIEW_CACHE cache. The version itself always
+comes from the primary database, so a per-process cache is still
+correct, just hit less often than a shared one, and a lagging replica
+can't serve a page from before the user's own last write. Set
+RAVEN_VIEW_CACHE_TIMEOUT to 0 to turn caching, and the ETags that go
+with it, off.
+'''
+import hashlib
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import router
+
+from raven.models import UserSequence
+
+HITS_KEY = 'raven:viewcache:hits'
+MISSES_KEY = 'raven:viewcache:misses'
+# The longest memcached will take as a relative timeout.
+COUNTER_TIMEOUT = 30 * 24 * 60 * 60
+
+
+def timeout():
+    return getattr(settings, 'RAVEN_VIEW_CACHE_TIMEOUT', 0)
+
+
+def enabled():
+    return timeout() > 0
+
+
+def _cache():
+    return get_cache(getattr(settings, 'RAVEN_VIEW_CACHE', 'default'))
+
+
+def current_version(user_id):
+    '''The user's data version, which changes whenever they change.'''
+    return UserSequence.current(
+        user_id, using=router.db_for_write(UserSequence))
+
+
+def _key(user_id, name, version, parts):
+    # Hash the parts, which may be a whole query string: memcached keys
+    # must be short and can't hold spaces.
+    return 'raven:view:%s:%s:%s:%s' % (
+        user_id, version, name, hashlib.md5(repr(parts)).hexdigest())
+
+
+def etag(user_id, name, version, parts=()):
+    '''An opaque tag for user_id's name page at version, for conditional
+    GETs. It changes exactly when the cache key does.'''
+    return hashlib.md5(_key(user_id, name, version, parts)).hexdigest()
+
+
+def _count(cache, key):
+    if not cache.add(key, 1, COUNTER_TIMEOUT):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired or evicted between the add and the incr.
+            pass
+
+
+def get_or_set(user_id, name, build, parts=(), version=None):
+    '''Return what build() returns for user_id's name page, from the
+    cache if it was built since the user last changed anything.
+
+    parts tell apart different pages with the same name, like query
+    strings. Pass version if you already have it, to save looking it up
+    again. If build() returns None, nothing is cached.
+    '''
+    if not enabled():
+        return build()
+    if version is None:
+        version = current_version(user_id)
+
+    cache = _cache()
+    key = _key(user_id, name, version, parts)
+    value = cache.get(key)
+    if value is not None:
+        _count(cache, HITS_KEY)
+        return value
+
+    _count(cache, MISSES_KEY)
+    value = build()
+    if value is not None:
+        cache.set(key, value, timeout())
+    return value
+
+
+def stats():
+    '''Return a dict of cache hits and misses so far.'''
+    cache = _cache()
+    return {
+        'hits': cache.get(HITS_KEY) or 0,
+        'misses': cache.get(MISSES_KEY) or 0,
+    }
@@ -5,12 +5,25 @@ from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils.encoding import force_text
+from django.utils.safestring import mark_safe
 
-from raven.models import UserFeed, UserFeedItem
+from raven import viewcache, writebehind
+from raven.models import UserFeed
+from raven.resources import UserFeedItemResource
 
 logger = logging.getLogger('django')
 User = get_user_model()
 
+SCRIPT_ESCAPES = (
+    (u'<', u'\\u003c'),
+    (u'>', u'\\u003e'),
+    (u'&', u'\\u0026'),
+    (u'\u2028', u'\\u2028'),
+    (u'\u2029', u'\\u2029'),
+)
+
 
 def index(request):
     if request.user.is_authenticated() and request.user.is_customer():
@@ -36,40 +49,145 @@ def home(request):
 @user_passes_test(lambda u: u.is_customer(), login_url='/usher/sign_up')
 def feedlist(request):
     '''Fragment for the feed list.'''
-    tags = UserFeed.userfeed_tags(request.user)
-    untagged_feeds = UserFeed.objects.filter(user=request.user).exclude(tags__in=tags).order_by('feed__title')
-    context = {
-        'tags': tags,
-        'untagged_feeds': untagged_feeds
+    writebehind.flush(request.user.pk)
+
+    def build():
+        tags = UserFeed.userfeed_tags(request.user)
+        untagged_feeds = UserFeed.objects.filter(user=request.user).exclude(tags__in=tags).order_by('feed__title')
+        context = {
+            'tags': tags,
+            'untagged_feeds': untagged_feeds
+        }
+        return render_to_string(
+            'raven/feedlist.html', context,
+            context_instance=RequestContext(request))
+    return HttpResponse(
+        viewcache.get_or_set(request.user.pk, 'feedlist', build))
+
+
+def _leftside_context(user):
+    '''The feeds, grouped by tag, and unread counts for the left side.
+
+    All the unread counts come off the denormalised UserFeed.unread, so
+    this is one query for the feeds and one for their tags, however many
+    feeds the user has.
+    '''
+    userfeeds = UserFeed.objects.filter(user=user).select_related(
+        'feed').order_by('feed__title')
+    tags_by_userfeed = UserFeed.tags_by_userfeed(user)
+
+    tags = {}
+    untagged_feeds = []
+    for userfeed in userfeeds:
+        feed_tags = tags_by_userfeed.get(userfeed.pk)
+        userfeed.tag_names = [tag.name for tag in feed_tags or []]
+        if not feed_tags:
+            untagged_feeds.append(userfeed)
+            continue
+        for tag in feed_tags:
+            tag = tags.setdefault(tag.pk, tag)
+            if not hasattr(tag, 'feeds'):
+                tag.feeds = []
+                tag.unread_count = 0
+            tag.feeds.append(userfeed)
+            tag.unread_count += userfeed.unread
+
+    return {
+        'feeds': userfeeds,
+        'tags': sorted(tags.values(), key=lambda tag: tag.name),
+        'unread_count': sum(userfeed.unread for userfeed in userfeeds),
+        'untagged_feeds': untagged_feeds,
+        'untagged_unread_count': sum(
+            userfeed.unread for userfeed in untagged_feeds),
     }
-    return render_to_response(
-        'raven/feedlist.html', context,
+
+
+def _render_leftside(request, context):
+    return render_to_string(
+        'raven/leftside.html', context,
         context_instance=RequestContext(request))
 
 
+def _bootstrap(request, context):
+    '''Everything the reader asks for when it first loads, as JSON: the
+    subscriptions, their tags, the unread counts and the first page of
+    unread items.'''
+    resource = UserFeedItemResource(api_name='0.9.5')
+    data = {
+        'feeds': [{
+            'id': userfeed.pk,
+            'link': userfeed.feed.link,
+            'title': userfeed.feed.title,
+            'unread': userfeed.unread,
+            'tags': userfeed.tag_names,
+        } for userfeed in context['feeds']],
+        'tags': [{
+            'name': tag.name,
+            'unread': tag.unread_count,
+            'feeds': [userfeed.pk for userfeed in tag.feeds],
+        } for tag in context['tags']],
+        'unread': context['unread_count'],
+        'untagged_unread': context['untagged_unread_count'],
+        'items': resource.first_page(request),
+    }
+    # Escape anything that could close the <script> tag the JSON goes in,
+    # or that JavaScript won't take raw in a string literal.
+    content = force_text(
+        resource.serialize(request, data, 'application/json'))
+    for char, escaped in SCRIPT_ESCAPES:
+        content = content.replace(char, escaped)
+    return content
+
+
 @login_required
 @user_passes_test(lambda u: u.is_customer(), login_url='/usher/sign_up')
 def leftside(request):
     '''Left side!'''
-    unread_count = UserFeedItem.objects.filter(read=False, user=request.user).count()
-    tags = UserFeed.userfeed_tags(request.user)
-    untagged_feeds = UserFeed.objects.filter(user=request.user).exclude(tags__in=tags).order_by('feed__title')
+    writebehind.flush(request.user.pk)
+    return HttpResponse(viewcache.get_or_set(
+        request.user.pk, 'leftside',
+        lambda: _render_leftside(request, _leftside_context(request.user))))
 
-    untagged_unread_count = 0
-    for userfeed in untagged_feeds:
-        untagged_unread_count = untagged_unread_count + userfeed.unread_count()
 
-    context = {
-        'tags': tags,
-        'unread_count': unread_count,
-        'untagged_feeds': untagged_feeds,
-        'untagged_unread_count': untagged_unread_count
-    }
+@login_required
+def reader(request):
+    '''The reader, with the left side and the first page of items
+    already in it, so it can show something without another request.'''
+    user_id = request.user.pk
+    writebehind.flush(user_id)
+    version = viewcache.current_version(user_id)
+    contexts = []
+
+    def context():
+        # Only needed if one of the two isn't cached.
+        if not contexts:
+            contexts.append(_leftside_context(request.user))
+        return contexts[0]
+
+    bootstrap = viewcache.get_or_set(
+        user_id, 'bootstrap', lambda: _bootstrap(request, context()),
+        version=version)
+    leftside = viewcache.get_or_set(
+        user_id, 'leftside', lambda: _render_leftside(request, context()),
+        version=version)
     return render_to_response(
-        'raven/leftside.html', context,
+        'raven/reader.html', {
+            'bootstrap': mark_safe(bootstrap),
+            'leftside': mark_safe(leftside),
+        },
         context_instance=RequestContext(request))
 
 
+@login_required
+def bootstrap(request):
+    '''The reader's bootstrap data on its own.'''
+    writebehind.flush(request.user.pk)
+    return HttpResponse(viewcache.get_or_set(
+        request.user.pk, 'bootstrap',
+        lambda: _bootstrap(request, _leftside_context(request.user))),
+        content_type='application/json')
+
+
 @login_required
 def jssucks(request):
     if request.method == 'POST':
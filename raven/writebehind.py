@@ -0,0 +1,196 @@
+'''A write-behind buffer for UserFeedItem read and starred state.
+
+Reading the river sends a steady stream of single-item PUTs, each of
+which would otherwise be its own write on the primary. With
+RAVEN_WRITE_BEHIND on, those changes are acknowledged straight away and
+parked in the cache, per user, then written out in batched
+UPDATE ... WHERE id IN (...) statements when:
+
+    * the user has RAVEN_WRITE_BEHIND_MAX changes waiting,
+    * the oldest waiting change is RAVEN_WRITE_BEHIND_DELAY seconds old,
+    * FlushReadStateBeat comes round, or
+    * the user reads anything that depends on item state, so they
+      always see their own writes (see flush()).
+
+The buffer lives in the default cache, so it has to be one every web and
+worker process shares (memcached, say), not the per-process default.
+'''
+from contextlib import contextmanager
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F
+
+from raven.models import UserFeed, UserFeedItem, UserSequence, sequenced
+
+# How long an unflushed buffer may sit in the cache. Far longer than it
+# should ever take FlushReadStateBeat to get to it.
+BUFFER_TIMEOUT = 60 * 60
+DIRTY_KEY = 'raven:writebehind:dirty'
+LOCK_TIMEOUT = 5
+LOCK_TRIES = 20
+LOCK_SLEEP = 0.01
+# Enough tries for any other holder's lock to have expired.
+FLUSH_LOCK_TRIES = int(LOCK_TIMEOUT / LOCK_SLEEP) + 1
+
+
+class BufferBusy(Exception):
+    '''A user's buffer stayed locked for longer than any lock lasts.'''
+
+
+def enabled():
+    return getattr(settings, 'RAVEN_WRITE_BEHIND', False)
+
+
+def _key(user_id):
+    return 'raven:writebehind:%s' % user_id
+
+
+@contextmanager
+def _locked(key, tries=LOCK_TRIES):
+    '''Hold a short-lived cache lock on key, yielding whether we got it.'''
+    lock = key + ':lock'
+    acquired = False
+    for i in xrange(tries):
+        acquired = cache.add(lock, 1, LOCK_TIMEOUT)
+        if acquired:
+            break
+        time.sleep(LOCK_SLEEP)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(lock)
+
+
+def _mark_dirty(user_id):
+    '''Note that user_id has something buffered, for flush_dirty().
+    Returns False if the dirty set was too contended to update.'''
+    with _locked(DIRTY_KEY) as locked:
+        if locked:
+            dirty = cache.get(DIRTY_KEY) or set()
+            dirty.add(user_id)
+            cache.set(DIRTY_KEY, dirty, BUFFER_TIMEOUT)
+    return locked
+
+
+def buffer(user_item):
+    '''Queue the changes to user_item's read and starred state to be
+    written later.
+
+    Only fields that differ from what was loaded are buffered, merged
+    into anything already waiting for the item, so a PUT that only marks
+    an item read can't undo a starring still in the buffer.
+
+    Returns False if the change wasn't buffered, because write-behind is
+    off or the buffer is contended, and the caller should just save().
+    '''
+    if not enabled() or user_item.pk is None:
+        return False
+
+    changes = user_item.changed_state()
+    if not changes:
+        return True
+
+    key = _key(user_item.user_id)
+    with _locked(key) as locked:
+        if not locked:
+            return False
+        pending = cache.get(key) or {'since': time.time(), 'items': {}}
+        pending['items'].setdefault(user_item.pk, {}).update(changes)
+        cache.set(key, pending, BUFFER_TIMEOUT)
+
+    if (len(pending['items']) >= getattr(
+            settings, 'RAVEN_WRITE_BEHIND_MAX', 100) or
+        time.time() - pending['since'] >= getattr(
+            settings, 'RAVEN_WRITE_BEHIND_DELAY', 10) or
+        not _mark_dirty(user_item.user_id)):
+        # Full, old, or nobody would know to flush it: do it now.
+        flush(user_item.user_id)
+    return True
+
+
+def flush(user_id):
+    '''Write out everything buffered for a user.
+
+    Call this before reading anything that depends on the user's item
+    state. Returns the number of items written.
+
+    The buffer stays locked until it has been written, so flushes land
+    in order. If someone else holds it, this waits for them, since
+    whatever they are adding or writing has to be in the database before
+    the caller reads it. Raises BufferBusy if the lock outlives its
+    timeout, which only a broken cache should do.
+    '''
+    if not enabled():
+        return 0
+
+    key = _key(user_id)
+    with _locked(key, tries=FLUSH_LOCK_TRIES) as locked:
+        if not locked:
+            raise BufferBusy(user_id)
+        pending = cache.get(key)
+        if not pending:
+            return 0
+        _write(user_id, pending['items'])
+        cache.delete(key)
+    return len(pending['items'])
+
+
+def _write(user_id, items):
+    by_change = {}
+    for pk, state in items.items():
+        for field, value in state.items():
+            by_change.setdefault((field, value), []).append(pk)
+
+    # Unread counter adjustments per feed, from the items whose read
+    # state actually changes.
+    unread = {}
+    batch_size = UserFeedItem.BATCH_SIZE
+    with sequenced(UserFeedItem) as db:
+        seq = UserSequence.advance([user_id])[user_id]
+        for (field, value), pks in by_change.items():
+            for i in xrange(0, len(pks), batch_size):
+                # Read and write on the same database, so the counts see
+                # every earlier flush.
+                user_items = UserFeedItem.objects.using(db).filter(
+                    user=user_id, pk__in=pks[i:i + batch_size])
+                if field == 'read':
+                    for feed, count in user_items.exclude(
+                            read=value).values_list('feed').annotate(
+                                Count('pk')):
+                        unread[feed] = unread.get(feed, 0) + (
+                            -count if value else count)
+                user_items.update(seq=seq, **{field: value})
+
+        by_delta = {}
+        for feed, delta in unread.items():
+            if delta:
+                by_delta.setdefault(delta, []).append(feed)
+        for delta, feeds in by_delta.items():
+            UserFeed.objects.using(db).filter(
+                user=user_id, feed__in=feeds).update(
+                    unread=F('unread') + delta)
+
+
+def flush_dirty():
+    '''Flush every user with something buffered.'''
+    if not enabled():
+        return 0
+
+    with _locked(DIRTY_KEY) as locked:
+        if not locked:
+            # Whoever has it is adding to it; catch them next time.
+            return 0
+        dirty = cache.get(DIRTY_KEY) or set()
+        cache.delete(DIRTY_KEY)
+
+    count = 0
+    for user_id in dirty:
+        try:
+            count += flush(user_id)
+        except BufferBusy:
+            # Try them again next time.
+            _mark_dirty(user_id)
+    return count
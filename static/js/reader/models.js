@@ -30,21 +30,28 @@ APP.Collections.Items = Backbone.Collection.extend({
         this.fetch({remove: false, success: this.success});
     },
     hasNext: function() {
-        return (this.length !== this.total);
+        return (this.next !== null);
     },
     model: Item,
+    next: null,
     params: {},
     success: function(self, res, options) {
-        if (self.total != res.meta.total_count) {
+        /* Only the first page is counted. */
+        if (res.meta.total_count !== undefined &&
+                self.total != res.meta.total_count) {
             self.total = res.meta.total_count;
         }
         if (self.params.limit != res.meta.limit) {
             self.params.limit = res.meta.limit;
         }
-        self.params.offset = res.meta.offset+self.params.limit;
+        /* The API pages with an opaque cursor, so just follow its link. */
+        self.next = res.meta.next;
     },
     total: 0,
     url: function() {
+        if (this.next) {
+            return this.next;
+        }
         var params = _.defaults(this.params, this.defaultParams);
         for (var param in params) { if (params.hasOwnProperty(param)) {
             if (params[param] == '~~~') {
@@ -130,6 +130,9 @@ APP.Views.LeftSide = Backbone.View.extend({
         /* While we have two sets of UI, this is an agreeable workaround. */
         if (window.location.pathname.indexOf('home') > -1) {
             this.$el.load('/raven/_feedlist/');
+        } else if (this.$el.children().length) {
+            /* Already rendered into the page by the reader view. */
+            this.loaded();
         } else {
             this.$el.load('/reader/leftside/', _.bind(this.loaded, this));
         }
@@ -227,8 +230,17 @@ APP.Views.FeedItemList = StrongSideView.extend({
         } else {
             delete this.items.params.read;
         }
-        this.items.params.offset = 0;
-        this.items.fetch({reset: true, success: this.items.success});
+        this.items.next = null;
+        if (_.isEmpty(config) && window.BOOTSTRAP && window.BOOTSTRAP.items) {
+            /* The page came with the first page of unread items. */
+            var res = window.BOOTSTRAP.items;
+            window.BOOTSTRAP.items = null;
+            _.defaults(this.items.params, this.items.defaultParams);
+            this.items.reset(this.items.parse(res));
+            this.items.success(this.items, res);
+        } else {
+            this.items.fetch({reset: true, success: this.items.success});
+        }
 
         this.show();
     },
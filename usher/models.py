@@ -74,6 +74,14 @@ class User(AbstractBaseUser):
     def subscribe(self, feed):
         feed.add_subscriber(self)
 
+    def delete(self, *args, **kwargs):
+        # Clear out the reading history in bulk first. Left to the
+        # deletion collector, every UserFeedItem would be loaded into
+        # memory just to cascade its tags.
+        from raven.models import UserFeed
+        UserFeed.remove_user(self)
+        super(User, self).delete(*args, **kwargs)
+
     def is_customer(self):
         # 6/4/2013
         # Enough early testers have said that the credit card is a